@@ -0,0 +1,124 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Adapter micro-benchmarks
+
+Run with::
+
+  python benchmarks/adapters.py
+"""
+import struct
+import time
+import zc.ngi.adapters
+
+READ_SIZE = 8192
+
+class Connection:
+    """Minimal connection that does nothing but hold a handler
+    """
+
+    def set_handler(self, handler):
+        self.handler = handler
+
+    def write(self, data, callback=None, priority=0):
+        pass
+
+class Handler:
+
+    count = 0
+
+    def handle_input(self, connection, data):
+        self.count += 1
+
+def best(func, repeat=5):
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return min(times)
+
+def sized_decoding(sizes=(0, 16, 128, 1024, 8192, 65536), total=1<<23):
+    """Time decoding of sized messages arriving in READ_SIZE inputs
+    """
+    print 'Sized decoding, %d-byte reads' % READ_SIZE
+    print '%10s %12s %12s' % ('size', 'frames/s', 'MB/s')
+    for size in sizes:
+        frame = struct.pack(">I", size) + 'x' * size
+        data = frame * max(total // len(frame), 1)
+        reads = [data[i:i+READ_SIZE] for i in range(0, len(data), READ_SIZE)]
+        nframes = len(data) // len(frame)
+
+        def run():
+            connection = Connection()
+            adapter = zc.ngi.adapters.Sized(connection)
+            handler = Handler()
+            adapter.set_handler(handler)
+            handle_input = connection.handler.handle_input
+            for read in reads:
+                handle_input(connection, read)
+            assert handler.count == nframes
+
+        t = best(run)
+        print '%10d %12.0f %12.1f' % (size, nframes / t, len(data) / t / 1e6)
+
+class Forwarding(zc.ngi.adapters.Base):
+    """Layer that forwards input and output with explicit method calls
+    """
+
+    def write(self, data, callback=None, priority=0):
+        self.connection.write(data, callback, priority)
+
+    def handle_input(self, connection, data):
+        self.handler.handle_input(self, data)
+
+def adapter_layers(nframes=200000):
+    """Time per-message input and output with 1, 2 and 3 adapter layers
+
+    The outer layers are either plain ``Base`` adapters, whose
+    methods are bound through to the adjacent layer, or adapters
+    that forward each call explicitly.
+    """
+    frame = struct.pack(">I", 16) + 'x' * 16
+    message = 'x' * 16
+    print
+    print 'Per-message overhead, %d-byte messages' % len(message)
+    print '%8s %12s %12s %12s' % ('layers', 'kind', 'input us', 'output us')
+    for layers in (1, 2, 3):
+        for kind, layer in (('bound', zc.ngi.adapters.Base),
+                            ('forwarding', Forwarding)):
+            if layers == 1 and kind == 'forwarding':
+                continue
+            adapters = (zc.ngi.adapters.Sized, ) + (layer, ) * (layers - 1)
+            connection = Connection()
+            adapter = zc.ngi.adapters.stack(*adapters)(connection)
+            handler = Handler()
+            adapter.set_handler(handler)
+            handle_input = connection.handler.handle_input
+            write = adapter.write
+
+            def input():
+                for i in xrange(nframes):
+                    handle_input(connection, frame)
+
+            def output():
+                for i in xrange(nframes):
+                    write(message)
+
+            print '%8d %12s %12.3f %12.3f' % (
+                layers, kind,
+                best(input) / nframes * 1e6, best(output) / nframes * 1e6)
+
+if __name__ == '__main__':
+    sized_decoding()
+    adapter_layers()
@@ -13,28 +13,64 @@
 ##############################################################################
 """NGI connection adapters
 """
+from __future__ import with_statement
+
 import struct
+import threading
 import warnings
 import zc.ngi.generator
+import zlib
+
+pack = struct.pack
+unpack = struct.unpack
+unpack_from = struct.unpack_from
+NULL_SIZE = 0xffffffff
+NULL_MESSAGE = pack(">I", NULL_SIZE)
+
+# Sized messages at least this large are written with their sizes as
+# a tuple, rather than being copied to a single string.
+LARGE_MESSAGE = 1 << 16
 
 class Base(object):
+    """Base class for connection adapters
+
+    Methods that an adapter class doesn't override are bound directly
+    to the methods of the adapted connection (for output) and of the
+    handler (for input) when the adapter is created and when its
+    handler is set.  Layers that only adapt input or output thus add
+    no calls in the other direction.
+    """
 
     def __init__(self, connection):
         self.connection = connection
+        for name in _output_methods:
+            if _passes_through(self.__class__, name):
+                method = getattr(connection, name, None)
+                if method is not None:
+                    setattr(self, name, method)
 
     def close(self):
         self.connection.close()
 
-    def write(self, data):
+    def write(self, data, callback=None, priority=0):
         self.write = self.connection.write
-        self.write(data)
+        _write(self.write, data, callback, priority)
 
-    def writelines(self, data):
+    def writelines(self, data, callback=None, prefetch=None, priority=0):
         self.writelines = self.connection.writelines
-        self.writelines(data)
+        _writelines(self.writelines, data, callback, prefetch, priority)
 
     def set_handler(self, handler):
         self.handler = handler
+        self._handle_input_batch = getattr(
+            handler, 'handle_input_batch', None)
+        for name in _input_methods:
+            if _passes_through(self.__class__, name):
+                method = getattr(handler, name, None)
+                if method is None:
+                    self.__dict__.pop(name, None)
+                else:
+                    setattr(self, name, method)
         try:
             self.connection.set_handler(self)
         except AttributeError:
@@ -48,8 +84,7 @@ class Base(object):
         self.set_handler(handler)
 
     def handle_input(self, connection, data):
-        handle_input = self.handler.handle_input
-        self.handle_input(connection, data)
+        self.handler.handle_input(connection, data)
 
     def handle_close(self, connection, reason):
         self.handler.handle_close(connection, reason)
@@ -68,71 +103,489 @@ class Base(object):
     def __nonzero__(self):
         return bool(self.connection)
 
+# Optional arguments are only passed to adapted connections when
+# they're given, so connections whose write methods predate them can
+# still be adapted.
+
+def _write(write, data, callback, priority):
+    if priority:
+        write(data, callback, priority)
+    elif callback is not None:
+        write(data, callback)
+    else:
+        write(data)
+
+def _writelines(writelines, data, callback, prefetch, priority):
+    if priority:
+        writelines(data, callback, prefetch, priority)
+    elif prefetch is not None:
+        writelines(data, callback, prefetch)
+    elif callback is not None:
+        writelines(data, callback)
+    else:
+        writelines(data)
+
+_output_methods = 'write', 'writelines', 'close'
+_input_methods = 'handle_input', 'handle_close', 'handle_exception'
+
+_pass_through_cache = {}
+def _passes_through(class_, name):
+    """Return whether a class uses the Base implementation of a method
+    """
+    try:
+        return _pass_through_cache[class_, name]
+    except KeyError:
+        for c in class_.__mro__:
+            if name in c.__dict__:
+                result = _pass_through_cache[class_, name] = c is Base
+                return result
+
+class stack:
+    """Compose adapters, innermost first, into a single adapter
+
+    For example, ``stack(Sized, Compressed)`` adapts a connection with
+    ``Sized`` and then adapts the result with ``Compressed``.  Stacks
+    have a ``handler`` method for defining generator-based handlers,
+    as adapter classes do.
+    """
+
+    def __init__(self, *adapters):
+        self.adapters = adapters
+
+    def __call__(self, connection):
+        for adapter in self.adapters:
+            connection = adapter(connection)
+        return connection
+
+    def handler(self, func):
+        return zc.ngi.generator.handler(func, self)
+
+def unwrap(connection):
+    """Return the connection underlying any adapters
+    """
+    while isinstance(connection, Base):
+        connection = connection.connection
+    return connection
+
+class LineTooLong(Exception):
+    """A line was longer than the maximum line length
+    """
+
 class Lines(Base):
+    """Break input into lines
+
+    Lines are separated by a delimiter, which is a newline by
+    default.  If a maximum line length is given, LineTooLong is raised
+    when a longer line is received, causing the connection to be
+    closed.
 
-    input = ''
+    If the handler has a ``handle_input_batch`` method, it's called
+    with a list of the lines in each input, rather than calling
+    ``handle_input`` for each line.
+    """
+
+    delimiter = '\n'
+    max_line_length = None
+
+    def __init__(self, connection, delimiter=None, max_line_length=None):
+        Base.__init__(self, connection)
+        if delimiter is not None:
+            self.delimiter = delimiter
+        if max_line_length is not None:
+            self.max_line_length = max_line_length
+        self.input = [] # Pending data without a delimiter
+        self.size = 0   # Number of pending bytes
 
     def handle_input(self, connection, data):
-        self.input += data
-        data = self.input.split('\n')
-        self.input = data.pop()
-        for line in data:
-            self.handler.handle_input(self, line)
+        delimiter = self.delimiter
+        input = self.input
+        if input and len(delimiter) > 1:
+            # The delimiter may span reads, so rescan the end of the
+            # pending data.
+            keep = len(delimiter) - 1
+            last = input.pop()
+            if len(last) < keep and input:
+                last = ''.join(input) + last
+                del input[:]
+            tail = last[-keep:]
+            data = tail + data
+            last = last[:-keep]
+            if last:
+                input.append(last)
+            self.size -= len(tail)
+
+        lines = data.split(delimiter)
+        rest = lines.pop()
+        if lines and input:
+            input.append(lines[0])
+            lines[0] = ''.join(input)
+            del input[:]
+            self.size = 0
+
+        if rest:
+            input.append(rest)
+            self.size += len(rest)
+
+        max_line_length = self.max_line_length
+        if max_line_length is not None:
+            if (self.size > max_line_length or
+                (lines and max(map(len, lines)) > max_line_length)
+                ):
+                del input[:]
+                self.size = 0
+                raise LineTooLong(max_line_length)
+
+        if lines:
+            if self._handle_input_batch is not None:
+                self._handle_input_batch(self, lines)
+            else:
+                handle_input = self.handler.handle_input
+                for line in lines:
+                    handle_input(self, line)
+
 
+class MessageTooLarge(Exception):
+    """A message was larger than the maximum message size
+    """
 
 class Sized(Base):
+    """Send and receive messages prefixed by 4-byte big-endian sizes
+
+    Input is decoded by walking each input string with an offset.
+    Messages that are contained in a single input are delivered as
+    slices of the input, without intermediate copies.  Data are only
+    buffered for messages and sizes that span inputs.
+
+    If the handler has a ``handle_input_batch`` method, it's called
+    with a list of the messages in each input, rather than calling
+    ``handle_input`` for each message.
+
+    If a maximum message size is given, MessageTooLarge is raised
+    when a larger message size is received, causing the connection to
+    be closed.
+
+    Handlers that provide a ``handle_message_start`` method have
+    messages streamed to them, rather than buffered.  They're called
+    with ``handle_message_start(connection, size)``, then
+    ``handle_message_data(connection, data)`` for each part of the
+    message as it's received, and finally
+    ``handle_message_end(connection)``.
+    """
 
     want = 4
     got = 0
     getting_size = True
+    max_message_size = None
+    streaming = False
+
+    def __init__(self, connection, max_message_size=None):
+        Base.__init__(self, connection)
+        if max_message_size is not None:
+            self.max_message_size = max_message_size
 
     def set_handler(self, handler):
         self.input = []
+        self.streaming = getattr(handler, 'handle_message_start', None
+                                 ) is not None
         Base.set_handler(self, handler)
 
+    def _check_size(self, size):
+        max_message_size = self.max_message_size
+        if max_message_size is not None and size > max_message_size:
+            self.input = []
+            self.got = 0
+            raise MessageTooLarge(size, max_message_size)
+
     def handle_input(self, connection, data):
-        self.got += len(data)
-        self.input.append(data)
-        while self.got >= self.want:
-            extra = self.got - self.want
-            if extra == 0:
-                collected = ''.join(self.input)
-                self.input = []
+        if self.streaming:
+            return self._stream_input(data)
+
+        want = self.want
+        getting_size = self.getting_size
+        if self._handle_input_batch is None:
+            batch = None
+            handle_input = self.handler.handle_input
+        else:
+            batch = []
+            add = batch.append
+        max_size = self.max_message_size
+        if max_size is None:
+            max_size = NULL_SIZE
+        pos = 0
+        end = len(data)
+
+        if self.got:
+            # Finish the size or message started in earlier input.
+            need = want - self.got
+            if end < need:
+                self.input.append(data)
+                self.got += end
+                return
+            self.input.append(data[:need])
+            collected = ''.join(self.input)
+            self.input = []
+            self.got = 0
+            pos = need
+            if getting_size:
+                want = unpack(">I", collected)[0]
+                if want == NULL_SIZE:
+                    want = 4
+                else:
+                    if want > max_size:
+                        self._check_size(want)
+                    getting_size = False
+            else:
+                if batch is None:
+                    handle_input(self, collected)
+                else:
+                    add(collected)
+                want = 4
+                getting_size = True
+
+        while 1:
+            if getting_size:
+                if end - pos < 4:
+                    break
+                want = unpack_from(">I", data, pos)[0]
+                pos += 4
+                if want == NULL_SIZE:
+                    # NULL message. Ignore
+                    continue
+                if want > max_size:
+                    self._check_size(want)
+                getting_size = False
+            if end - pos < want:
+                break
+            if batch is None:
+                handle_input(self, data[pos:pos+want])
             else:
-                input = self.input
-                self.input = [data[-extra:]]
-                input[-1] = input[-1][:-extra]
-                collected = ''.join(input)
+                add(data[pos:pos+want])
+            pos += want
+            getting_size = True
 
-            self.got = extra
+        if getting_size:
+            want = 4
+        if pos < end:
+            self.input.append(data[pos:])
+            self.got = end - pos
+        self.want = want
+        self.getting_size = getting_size
+        if batch:
+            self._handle_input_batch(self, batch)
 
+    remaining = 0 # Bytes remaining in a streamed message
+    def _stream_input(self, data):
+        handler = self.handler
+        pos = 0
+        end = len(data)
+        while pos < end:
             if self.getting_size:
-                # we were recieving the message size
-                assert self.want == 4
-                if collected == '\xff\xff\xff\xff':
-                    # NULL message. Ignore
+                need = 4 - self.got
+                if end - pos < need:
+                    self.input.append(data[pos:])
+                    self.got += end - pos
+                    return
+                if self.got:
+                    self.input.append(data[pos:pos+need])
+                    size = unpack(">I", ''.join(self.input))[0]
+                    self.input = []
+                    self.got = 0
+                else:
+                    size = unpack_from(">I", data, pos)[0]
+                pos += need
+                if size == NULL_SIZE:
                     continue
-                self.want = struct.unpack(">I", collected)[0]
+                self._check_size(size)
                 self.getting_size = False
+                self.remaining = size
+                handler.handle_message_start(self, size)
             else:
-                self.want = 4
+                n = min(self.remaining, end - pos)
+                handler.handle_message_data(self, data[pos:pos+n])
+                pos += n
+                self.remaining -= n
+
+            if not (self.getting_size or self.remaining):
                 self.getting_size = True
-                self.handler.handle_input(self, collected)
+                handler.handle_message_end(self)
 
-    def writelines(self, data):
-        self.connection.writelines(sized_iter(data))
+    # Each message is written with its size as a single string, or,
+    # if it's large, as a tuple of strings, so that higher-priority
+    # output can't be sent between them.
 
-    def write(self, message):
+    def writelines(self, data, callback=None, prefetch=None, priority=0):
+        _writelines(self.connection.writelines, sized_iter(data),
+                    callback, prefetch, priority)
+
+    def write(self, message, callback=None, priority=0):
         if message is None:
-            self.connection.write('\xff\xff\xff\xff')
+            _write(self.connection.write, NULL_MESSAGE, callback, priority)
+        elif len(message) < LARGE_MESSAGE:
+            _write(self.connection.write, pack(">I", len(message)) + message,
+                   callback, priority)
         else:
-            self.connection.write(struct.pack(">I", len(message)))
-            self.connection.write(message)
+            # Don't copy large messages just to prepend the size
+            _writelines(self.connection.writelines,
+                        (pack(">I", len(message)), message),
+                        callback, None, priority)
+
+    def write_many(self, messages, callback=None, priority=0):
+        """Write a sequence of messages with a single write
+        """
+        _write(self.connection.write, frame_many(messages),
+               callback, priority)
+
+def frame(message):
+    """Return a string containing a message with its size
+    """
+    if message is None:
+        return NULL_MESSAGE
+    return pack(">I", len(message)) + message
 
 def sized_iter(data):
     for message in data:
         if message is None:
-            yield '\xff\xff\xff\xff'
+            yield NULL_MESSAGE
         else:
-            yield struct.pack(">I", len(message))
-            yield message
+            yield pack(">I", len(message)) + message
+
+def frame_many(messages):
+    """Return a string containing the given messages with their sizes
+    """
+    n = len(messages)
+    sizes = pack(">%dI" % n,
+                 *[NULL_SIZE if m is None else len(m) for m in messages])
+    parts = [None] * (2 * n)
+    parts[::2] = [sizes[i:i+4] for i in xrange(0, 4 * n, 4)]
+    parts[1::2] = [m or '' for m in messages]
+    return ''.join(parts)
+
+class Compressed(Base):
+    """Compress messages with zlib
+
+    This adapter works with messages, so it's used on top of a
+    message-oriented adapter, typically ``Sized``::
+
+      stack(Sized, Compressed)
+
+    Each connection has its own compression and decompression
+    streams, and each message is flushed with a sync flush, so later
+    messages can refer to data in earlier ones.  Messages are prefixed
+    with a byte that tells whether they're compressed.  Messages
+    smaller than ``min_size`` are sent uncompressed, as are the next
+    ``backoff`` messages after a message doesn't compress.
+
+    If a ``dictionary`` of data that messages are likely to contain is
+    given, both streams are primed with it, so that even the first
+    messages compress well.  Both ends must use the same dictionary.
+
+    Decompressed messages larger than ``max_message_size`` aren't
+    expanded.  Rather, MessageTooLarge is raised, causing the
+    connection to be closed.
+
+    The ``writelines`` method compresses messages as they're sent.
+    Messages must be compressed in the order they're sent, so while
+    messages passed to ``writelines`` are waiting to be sent, messages
+    passed to ``write`` are compressed as they're sent too.  For the
+    same reason, write priorities are ignored, and prefetching, which
+    compresses messages in a separate thread, is only used when no
+    other messages are waiting to be compressed.  Messages may be
+    written from any thread.
+    """
+
+    level = 6
+    min_size = 64
+    backoff = 16
+    max_message_size = 1 << 24
+    dictionary = None
+
+    def __init__(self, connection, dictionary=None, level=None,
+                 min_size=None, max_message_size=None):
+        Base.__init__(self, connection)
+        if dictionary is not None:
+            self.dictionary = dictionary
+        if level is not None:
+            self.level = level
+        if min_size is not None:
+            self.min_size = min_size
+        if max_message_size is not None:
+            self.max_message_size = max_message_size
+        self.compressor = zlib.compressobj(self.level)
+        self.decompressor = zlib.decompressobj()
+        if self.dictionary:
+            # Put the dictionary in the windows of both streams.  The
+            # primed output isn't sent. The peer primes its
+            # decompressor the same way.
+            primed = (self.compressor.compress(self.dictionary) +
+                      self.compressor.flush(zlib.Z_SYNC_FLUSH))
+            self.decompressor.decompress(primed)
+        self.skip = 0
+        # Held while deciding when messages are compressed, and
+        # while compressing and queueing them at once, so they're
+        # queued in the order they're compressed.
+        self._lock = threading.RLock()
+
+    def _compress(self, message):
+        if message is None:
+            return None
+        if len(message) < self.min_size:
+            return RAW + message
+        if self.skip:
+            self.skip -= 1
+            return RAW + message
+        compressor = self.compressor
+        compressed = (compressor.compress(message) +
+                      compressor.flush(zlib.Z_SYNC_FLUSH))
+        if len(compressed) >= len(message):
+            # The compressed data must be sent anyway, to keep the
+            # peer's decompressor in sync.
+            self.skip = self.backoff
+        return COMPRESSED + compressed
+
+    # The number of iterators of messages to be compressed as they're
+    # sent that haven't been exhausted.
+    _lazy = 0
+
+    def write(self, message, callback=None, priority=0):
+        with self._lock:
+            if self._lazy:
+                self._writelines((message, ), callback, None)
+            else:
+                _write(self.connection.write, self._compress(message),
+                       callback, 0)
+
+    def writelines(self, data, callback=None, prefetch=None, priority=0):
+        with self._lock:
+            self._writelines(data, callback, prefetch)
+
+    def _writelines(self, data, callback, prefetch):
+        if self._lazy:
+            # Other iterators must be compressed first.
+            prefetch = None
+        self._lazy += 1
+        _writelines(self.connection.writelines, self._compress_iter(data),
+                    callback, prefetch, 0)
+
+    def _compress_iter(self, data):
+        try:
+            for message in data:
+                yield self._compress(message)
+        finally:
+            with self._lock:
+                self._lazy -= 1
+
+    def handle_input(self, connection, data):
+        flag = data[:1]
+        if flag == COMPRESSED:
+            max_size = self.max_message_size
+            data = self.decompressor.decompress(buffer(data, 1), max_size + 1)
+            if len(data) > max_size:
+                raise MessageTooLarge(max_size)
+        elif flag == RAW:
+            data = data[1:]
+        else:
+            raise ValueError("Invalid compressed message flag", flag)
+        self.handler.handle_input(self, data)
+
+RAW = '\0'
+COMPRESSED = '\1'
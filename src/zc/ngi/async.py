@@ -17,16 +17,26 @@ from __future__ import with_statement
 
 import asyncore
 import errno
+import heapq
+import itertools
 import logging
 import os
+import select
 import socket
+import ssl
+import struct
 import sys
 import thread
 import threading
 import time
+import traceback
 import warnings
+import weakref
 import zc.ngi
+import zc.ngi.adapters
+import zc.ngi.executor
 import zc.ngi.interfaces
+import zc.ngi.stats
 
 zc.ngi.interfaces.moduleProvides(zc.ngi.interfaces.IImplementation)
 
@@ -47,6 +57,47 @@ expected_socket_write_errors = {
     }
 
 BUFFER_SIZE = 8*1024
+SEND_SIZE = 60000
+
+# Whether the ssl module lets clients resume sessions.
+tls_sessions_supported = hasattr(ssl, 'SSLSession')
+
+# Whether the kernel's TCP connection information can be read.
+tcp_info_supported = hasattr(socket, 'TCP_INFO')
+
+# The start of Linux's struct tcp_info: 8 bytes of states and
+# flags, followed by 32-bit fields.
+_tcp_info = struct.Struct('8B24I')
+
+def tcp_info(sock):
+    """Return a dictionary of the kernel's information about a TCP socket
+
+    Times are in seconds.  None is returned if the information isn't
+    available, as for non-TCP sockets or on platforms other than
+    Linux.
+    """
+    if not tcp_info_supported:
+        return None
+    try:
+        data = sock.getsockopt(
+            socket.IPPROTO_TCP, socket.TCP_INFO, _tcp_info.size)
+    except socket.error:
+        return None
+    if len(data) < _tcp_info.size:
+        return None
+    info = _tcp_info.unpack(data)
+    fields = info[8:]
+    return dict(
+        state=info[0],
+        retransmits=info[2],
+        unacked=fields[4],
+        lost=fields[6],
+        retrans=fields[7],
+        rtt=fields[15] / 1e6,
+        rttvar=fields[16] / 1e6,
+        snd_cwnd=fields[18],
+        total_retrans=fields[23],
+        )
 
 
 def get_family_from_address(addr):
@@ -63,17 +114,94 @@ def get_family_from_address(addr):
     raise ValueError("addr should be string or tuple of ip address, port")
 
 
+# All implementations, for introspection.
+_implementations = weakref.WeakSet()
+
+def implementations():
+    """Return the implementations that haven't been garbage collected
+    """
+    return list(_implementations)
+
 class Implementation:
     zc.ngi.interfaces.implements(zc.ngi.interfaces.IImplementation)
 
     logger = logging.getLogger('zc.ngi.async.Implementation')
 
-    def __init__(self, daemon=True, name='zc.ngi.async application created'):
+    # Bytes of output buffered by connections, and the number of
+    # times connections exceeded output limits.
+    output_bytes = output_limit_exceeded = 0
+
+    # Statistics. See zc.ngi.stats.
+    counters = (
+        'connections_opened', 'connections_closed',
+        'bytes_read', 'bytes_written', 'sends', 'send_eagain',
+        'partial_writes', 'trigger_pulls', 'callbacks_called',
+        'loop_iterations', 'loop_stalls', 'output_limit_exceeded',
+        'tls_handshakes', 'tls_handshake_failures', 'tls_resumed',
+        )
+    connections_opened = connections_closed = 0
+    bytes_read = bytes_written = sends = send_eagain = partial_writes = 0
+    trigger_pulls = callbacks_called = loop_iterations = loop_stalls = 0
+
+    # Histogram of the time spent working in each loop iteration,
+    # when a watchdog is running.
+    loop_times = None
+
+    # A zc.ngi.stats.Trace of recent connection events, when tracing.
+    trace = None
+
+    def start_trace(self, size=10000, sample=1):
+        """Record recent connection events in a ring buffer
+
+        The most recent size events, for one in sample connections,
+        are recorded in the implementation's ``trace``.  When a
+        connection has an error, its recorded events are logged.
+        """
+        self.trace = zc.ngi.stats.Trace(size, sample)
+
+    def stop_trace(self):
+        """Stop tracing, returning the trace
+        """
+        trace = self.trace
+        self.trace = None
+        return trace
+
+    # TLS handshake metrics. Times are in seconds.
+    tls_handshakes = tls_handshake_failures = tls_resumed = 0
+    tls_handshake_time = tls_max_handshake_time = 0.0
+
+    def __init__(self, daemon=True, name='zc.ngi.async application created',
+                 executor_size=4, process_pool_size=None, coalesce_reads=None,
+                 read_budget=1<<20, write_budget=1<<20, callback_budget=1000,
+                 max_output=None, output_policy='close', stall_timeout=None):
         self.name = name
+        self.coalesce_reads = coalesce_reads
+        # Limits on the work done for each connection, and on the
+        # number of callbacks run, per loop pass.  Leftover work is
+        # resumed in the next pass, so one busy connection can't
+        # starve the others.
+        self.read_budget = read_budget
+        self.write_budget = write_budget
+        self.callback_budget = callback_budget
+        # Output buffered by connections is limited to max_output
+        # bytes. If it's exceeded, connections with more than their
+        # share, or that haven't sent anything for stall_timeout
+        # seconds, are handled according to their output policy.
+        self.max_output = max_output
+        self.output_policy = output_policy
+        self.stall_timeout = stall_timeout
+        self._output_lock = threading.Lock()
         self.daemon = daemon
         self._map = {}
         self._callbacks = []
         self._start_lock = threading.Lock()
+        self.executor = zc.ngi.executor.Executor(
+            self.call_from_thread, executor_size, name + ' executor')
+        self.process_executor = zc.ngi.executor.ProcessExecutor(
+            self.call_from_thread, process_pool_size)
+        self.tls_sessions = {} # {address -> client TLS session}
+        self._timers = [] # heap of (time, sequence, _Timer)
+        _implementations.add(self)
 
     thread_ident = None
     def call_from_thread(self, func):
@@ -87,12 +215,31 @@ class Implementation:
     def notify_select(self):
         pass
 
-    def connect(self, addr, handler):
-        self.call_from_thread(lambda : _Connector(addr, handler, self))
+    _timer_sequence = itertools.count()
+    def call_later(self, delay, func):
+        """Call a function from the loop after a delay, in seconds
+
+        An object with a ``cancel`` method is returned.
+        """
+        timer = _Timer(func)
+        item = time.time() + delay, self._timer_sequence.next(), timer
+        self.call_from_thread(lambda : heapq.heappush(self._timers, item))
+        return timer
+
+    def call_next_pass(self, func):
+        """Call a function from the loop's next pass
+
+        This must be called from the implementation's thread.
+        """
+        self._callbacks.append(func)
+
+    def connect(self, addr, handler, ssl_context=None):
+        self.call_from_thread(
+            lambda : _Connector(addr, handler, self, ssl_context))
         self.start_thread()
 
-    def listener(self, addr, handler, thready=False):
-        result = _Listener(addr, handler, self, thready)
+    def listener(self, addr, handler, thready=False, ssl_context=None):
+        result = _Listener(addr, handler, self, thready, ssl_context)
         self.start_thread()
         return result
 
@@ -111,6 +258,248 @@ class Implementation:
         self.start_thread()
         return result
 
+    _read_buffer = None
+    def read_buffer(self):
+        """Return a memoryview of the coalesce_reads-sized read buffer
+
+        The buffer is shared by connections and must only be used
+        from the implementation's thread.
+        """
+        view = self._read_buffer
+        if view is None or len(view) != self.coalesce_reads:
+            view = self._read_buffer = memoryview(
+                bytearray(self.coalesce_reads))
+        return view
+
+    def broadcast(self, connections, data, max_pending=None, priority=0):
+        # Queue the data for all of the connections in one callback,
+        # so there's a single wakeup.
+        assert isinstance(data, str)
+        future = zc.ngi.executor.Future(self.call_from_thread)
+        self.call_from_thread(lambda : future.set_result(
+            self._broadcast(connections, data, max_pending, priority)))
+        return future
+
+    def _broadcast(self, connections, data, max_pending, priority):
+        skipped = 0
+        for connection in list(connections):
+            dispatcher = zc.ngi.adapters.unwrap(connection)._dispatcher
+            if not dispatcher:
+                continue # closed
+            if (max_pending is not None and
+                dispatcher.output_size() > max_pending):
+                skipped += 1
+            elif dispatcher.implementation is self:
+                dispatcher.enqueue(data, priority)
+            else:
+                dispatcher.write(data, priority=priority)
+        return skipped
+
+    def listeners(self):
+        """Return the implementation's TCP listeners
+        """
+        return [d for d in self._map.values() if isinstance(d, _Listener)]
+
+    def stats(self):
+        """Return a dictionary of statistics
+
+        In addition to the counters, there are the numbers of open
+        connections and listeners, queued callbacks and pending
+        timers, and the number of bytes of output buffered.
+        """
+        result = dict((name, getattr(self, name)) for name in self.counters)
+        dispatchers = list(self._map.values())
+        result.update(
+            connections=len([d for d in dispatchers
+                             if isinstance(d, _ConnectionDispatcher)]),
+            listeners=len([d for d in dispatchers
+                           if isinstance(d, BaseListener)]),
+            callbacks=len(self._callbacks),
+            timers=len(self._timers),
+            output_bytes=self.output_bytes,
+            tls_handshake_time=self.tls_handshake_time,
+            tls_max_handshake_time=self.tls_max_handshake_time,
+            )
+        if self.loop_times is not None:
+            result['loop_times'] = self.loop_times
+        return result
+
+    def snapshot(self):
+        """Return a dictionary describing the implementation's state
+
+        The dictionary has the implementation's name and statistics,
+        and lists of dictionaries describing its listeners and
+        connections.  This must be called from the implementation
+        thread.
+        """
+        listeners = []
+        connections = []
+        for dispatcher in list(self._map.values()):
+            if isinstance(dispatcher, _ConnectionDispatcher):
+                connections.append(dispatcher.snapshot())
+            elif isinstance(dispatcher, _Listener):
+                listeners.append(dict(
+                    address=dispatcher.address,
+                    accepting=bool(dispatcher.accepting),
+                    stats=dispatcher.stats(),
+                    ))
+        connections.sort(key=lambda c: c['id'])
+        return dict(name=self.name, stats=self.stats(),
+                    listeners=listeners, connections=connections)
+
+    def close_connection(self, ident, reason='closed'):
+        """Close the connection with the given id
+
+        The connection's handler's ``handle_close`` method is called
+        with the reason.  Whether the connection was found is
+        returned.  This must be called from the implementation thread.
+        """
+        for dispatcher in list(self._map.values()):
+            if (isinstance(dispatcher, _ConnectionDispatcher) and
+                dispatcher.id == ident):
+                dispatcher.handle_close(reason)
+                return True
+        return False
+
+    _watchdog = None
+    def start_watchdog(self, threshold=1.0, interval=None):
+        """Watch for loop iterations that take too long
+
+        A thread checks, every interval seconds, whether the loop has
+        been working on an iteration for more than threshold
+        seconds.  If so, the stall is counted and logged with the
+        loop thread's stack, and the dispatcher and handler method
+        that were running.  The time spent working in each iteration
+        is recorded in the ``loop_times`` histogram until the watchdog
+        is stopped.
+        """
+        if interval is None:
+            interval = threshold / 4.0
+        self.stop_watchdog()
+        self.loop_times = zc.ngi.stats.Histogram()
+        self._watchdog = _Watchdog(self, threshold, interval)
+        self._watchdog.start()
+
+    def stop_watchdog(self):
+        watchdog = self._watchdog
+        if watchdog is not None:
+            self._watchdog = None
+            watchdog.stop()
+        self.loop_times = self._busy_since = None
+
+    def output_offenders(self, n=10):
+        """Return the connections with the most buffered output
+
+        A list of up to n tuples of the number of bytes buffered, the
+        number of seconds since output was last sent, and the
+        connection, is returned.
+        """
+        now = time.time()
+        result = []
+        for dispatcher in list(self._map.values()):
+            if isinstance(dispatcher, _ConnectionDispatcher):
+                size = dispatcher.output_size()
+                if size:
+                    result.append((size, now - dispatcher.output_sent,
+                                   dispatcher._connection))
+        result.sort(key=lambda item: -item[0])
+        return result[:n]
+
+    output_check_interval = 1.0
+    _output_timer = None
+    def start_output_checks(self, force=False):
+        """Start checking connections' output periodically
+
+        Checks are started if output limits are set, or if force is
+        true, and they aren't already running.
+        """
+        if self._output_timer is None and (
+            force or
+            self.max_output is not None or self.stall_timeout is not None):
+            self._output_timer = self.call_later(
+                self.output_check_interval, self.check_output)
+
+    def check_output(self):
+        """Check connections' output against limits
+
+        Checks are rescheduled as long as there are connections.
+        """
+        self._output_timer = None
+        dispatchers = [d for d in self._map.values()
+                       if isinstance(d, _ConnectionDispatcher)]
+        share = self.output_share(dispatchers)
+        now = time.time()
+        for dispatcher in dispatchers:
+            dispatcher.check_output(now, share)
+        if dispatchers:
+            self._output_timer = self.call_later(
+                self.output_check_interval, self.check_output)
+
+    def output_share(self, dispatchers=None):
+        # Return each connection's share of max_output, if it's
+        # exceeded, or None.
+        if self.max_output is None or self.output_bytes <= self.max_output:
+            return None
+        if dispatchers is None:
+            dispatchers = [d for d in self._map.values()
+                           if isinstance(d, _ConnectionDispatcher)]
+        backlogged = len([d for d in dispatchers if d.output_size()])
+        return self.max_output // max(backlogged, 1)
+
+    # Seconds between samples of connections' TCP information, or None.
+    tcp_sample_interval = None
+    _tcp_timer = None
+
+    def start_tcp_sampling(self, interval=10.0):
+        """Sample the kernel's information about TCP connections
+
+        Every interval seconds, each connection's RTT, congestion
+        window, unacknowledged packets and retransmits are read with
+        ``TCP_INFO`` and saved, with its buffered output, as the
+        connection's ``tcp_info``.  Listeners aggregate the samples of
+        their connections.
+        """
+        self.tcp_sample_interval = interval
+        self.call_from_thread(self._schedule_tcp_sampling)
+
+    def stop_tcp_sampling(self):
+        self.tcp_sample_interval = None
+        @self.call_from_thread
+        def _():
+            if self._tcp_timer is not None:
+                self._tcp_timer.cancel()
+                self._tcp_timer = None
+
+    def _schedule_tcp_sampling(self):
+        if (self._tcp_timer is None and self.tcp_sample_interval and
+            tcp_info_supported):
+            self._tcp_timer = self.call_later(
+                self.tcp_sample_interval, self.sample_tcp_info)
+
+    def sample_tcp_info(self):
+        """Sample connections' TCP information
+
+        This is called from the implementation thread.
+        """
+        self._tcp_timer = None
+        samples = {} # {listener -> [info]}
+        for dispatcher in list(self._map.values()):
+            if isinstance(dispatcher, _ConnectionDispatcher):
+                info = dispatcher.sample_tcp_info()
+                control = getattr(dispatcher, 'control', None)
+                if info is not None and control is not None:
+                    samples.setdefault(control, []).append(info)
+        for listener, infos in samples.items():
+            listener.tcp_sampled(infos)
+        if len(self._map) > 1:
+            self._schedule_tcp_sampling()
+
+    def run_in_executor(self, func, *args):
+        return self.executor.submit(func, *args)
+
+    def run_in_process(self, func, *args):
+        return self.process_executor.submit(func, *args)
+
     _thread = None
     def start_thread(self):
         with self._start_lock:
@@ -138,15 +527,37 @@ class Implementation:
             timeout = 30
         map = self._map
         callbacks = self._callbacks
+        timers = self._timers
         logger = logging.getLogger('zc.ngi.async.loop')
-        trigger = _Trigger(self._map)
-        self.notify_select = trigger.pull_trigger
+        trigger = self._trigger = _Trigger(self._map)
+        self.notify_select = self._pull_trigger
+        if self.loop_times is not None:
+            self._busy_since = time.time()
 
         try:
             while 1:
-
-                while callbacks:
+                self.loop_iterations += 1
+
+                if timers:
+                    now = time.time()
+                    # Cancelled timers are dropped early, so they
+                    # don't keep the loop running.
+                    while timers and (timers[0][0] <= now or
+                                      timers[0][2].func is None):
+                        func = heapq.heappop(timers)[2].func
+                        if func is None:
+                            continue # cancelled
+                        try:
+                            func()
+                        except:
+                            self.logger.exception('Calling timer')
+                            self.handle_error()
+
+                budget = self.callback_budget
+                while callbacks and budget:
+                    budget -= 1
                     callback = callbacks.pop(0)
+                    self.callbacks_called += 1
                     try:
                         callback()
                     except:
@@ -157,19 +568,30 @@ class Implementation:
                     timeout = min(deadline - time.time(), 30)
 
                 try:
-                    if (timeout > 0) and (len(map) > 1):
-                        asyncore.poll(timeout, map)
+                    if (timeout > 0) and (len(map) > 1 or timers):
+                        # Don't wait if there are callbacks left over,
+                        # or past the next timer.
+                        if callbacks:
+                            wait = 0.0
+                        elif timers:
+                            wait = max(min(timers[0][0] - time.time(),
+                                           timeout), 0.0)
+                        else:
+                            wait = timeout
+                        if self.loop_times is None:
+                            asyncore.poll(wait, map)
+                        else:
+                            self._timed_poll(wait, map)
                 except:
                     logger.exception('loop error')
                     raise
 
                 if trigger._fileno is None:
                     # oops, the trigger got closed.  Recreate it.
-                    trigger = _Trigger(self._map)
-                    self.notify_select = trigger.pull_trigger
+                    trigger = self._trigger = _Trigger(self._map)
 
                 with self._start_lock:
-                    if (len(map) <= 1) and not callbacks:
+                    if (len(map) <= 1) and not (callbacks or timers):
                         self._thread = None
                         return
 
@@ -178,8 +600,63 @@ class Implementation:
         finally:
             del self.thread_ident
             del self.notify_select
+            self._busy_since = None
             trigger.close()
 
+    def _pull_trigger(self):
+        self.trigger_pulls += 1
+        self._trigger.pull_trigger()
+
+    # When the loop started working on the current iteration, or
+    # None if it's waiting for events.
+    _busy_since = None
+
+    def _timed_poll(self, timeout, map):
+        # asyncore.poll, timing the work done between waits.
+        r = []; w = []; e = []
+        for fd, obj in map.items():
+            is_r = obj.readable()
+            is_w = obj.writable()
+            if is_r:
+                r.append(fd)
+            if is_w and not obj.accepting:
+                w.append(fd)
+            if is_r or is_w:
+                e.append(fd)
+
+        # The watchdog may be stopped from another thread.
+        loop_times = self.loop_times
+        busy_since = self._busy_since
+        now = time.time()
+        if busy_since is not None and loop_times is not None:
+            loop_times.record(now - busy_since)
+        self._busy_since = None
+        try:
+            if r or w or e:
+                r, w, e = select.select(r, w, e, timeout)
+            else:
+                time.sleep(timeout)
+        except select.error, err:
+            if err.args[0] != errno.EINTR:
+                raise
+            return
+        finally:
+            if self.loop_times is not None:
+                self._busy_since = time.time()
+
+        for fd in r:
+            obj = map.get(fd)
+            if obj is not None:
+                asyncore.read(obj)
+        for fd in w:
+            obj = map.get(fd)
+            if obj is not None:
+                asyncore.write(obj)
+        for fd in e:
+            obj = map.get(fd)
+            if obj is not None:
+                asyncore._exception(obj)
+
     def cleanup_map(self):
         for c in self._map.values():
             if isinstance(c, _Trigger):
@@ -193,6 +670,168 @@ class Implementation:
     def handle_error(self):
         pass
 
+    def tls_handshake_done(self, elapsed, resumed):
+        self.tls_handshakes += 1
+        self.tls_handshake_time += elapsed
+        if elapsed > self.tls_max_handshake_time:
+            self.tls_max_handshake_time = elapsed
+        if resumed:
+            self.tls_resumed += 1
+
+class _Watchdog(threading.Thread):
+
+    logger = logging.getLogger('zc.ngi.async.watchdog')
+
+    def __init__(self, implementation, threshold, interval):
+        threading.Thread.__init__(
+            self, name=implementation.name + ' watchdog')
+        self.setDaemon(True)
+        self.implementation = implementation
+        self.threshold = threshold
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        implementation = self.implementation
+        reported = None
+        while not self.stopped.wait(self.interval):
+            busy_since = implementation._busy_since
+            ident = implementation.thread_ident
+            if busy_since is None or ident is None or busy_since == reported:
+                continue
+            elapsed = time.time() - busy_since
+            if elapsed < self.threshold:
+                continue
+            frame = sys._current_frames().get(ident)
+            if frame is None or implementation._busy_since != busy_since:
+                continue
+            reported = busy_since
+            implementation.loop_stalls += 1
+            self.logger.warning(
+                "%s loop stalled for %.3f seconds in %s\n%s",
+                implementation.name, elapsed, _describe_frame(frame),
+                ''.join(traceback.format_stack(frame)))
+
+def _describe_frame(frame):
+    """Describe the dispatcher and handler method running in a frame
+
+    The frame is typically the loop thread's current frame, obtained
+    from ``sys._current_frames``.
+    """
+    callee = None
+    while frame is not None:
+        ob = frame.f_locals.get('self')
+        if isinstance(ob, asyncore.dispatcher):
+            where = '%s %r %s' % (
+                ob.__class__.__name__, getattr(ob, 'addr', None),
+                frame.f_code.co_name)
+            if callee is not None:
+                name = callee.f_code.co_name
+                handler = callee.f_locals.get('self')
+                if handler is not None:
+                    name = handler.__class__.__name__ + '.' + name
+                where += ' calling ' + name
+            return where
+        callee = frame
+        frame = frame.f_back
+    return 'callback or timer'
+
+class _Timer:
+
+    def __init__(self, func):
+        self.func = func
+
+    def cancel(self):
+        self.func = None
+
+class TokenBucket:
+    """Limit a rate of bytes per second
+
+    Up to ``burst`` bytes may be used at once.  The burst defaults to
+    a tenth of a second's worth, but at least BUFFER_SIZE.
+
+    The ``total`` attribute is the number of bytes used and the
+    ``current_rate`` method returns the rate, in bytes per second, at
+    which bytes were used over the last second or so.
+
+    Users of a bucket that runs out wait for it to refill together,
+    and then share the available bytes equally, so buckets shared by
+    many connections don't favor whichever connection reads first.
+    """
+
+    total = 0
+
+    # The bytes each user may use at once, while users are sharing
+    # the bucket, or None.
+    share = None
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        if burst is None:
+            burst = max(rate // 10, BUFFER_SIZE)
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.time()
+        # Rates are measured from the older of 2 samples taken about
+        # a second apart.
+        self._samples = [(self.updated, 0)] * 2
+        self._waiting = []
+
+    def available(self, now):
+        tokens = self.tokens + (now - self.updated) * self.rate
+        if tokens > self.burst:
+            tokens = self.burst
+        self.tokens = tokens
+        self.updated = now
+        return int(tokens)
+
+    def consume(self, n, now):
+        self.tokens -= n
+        self.total += n
+        self.current_rate(now)
+
+    def delay(self, n):
+        """Return how long until n bytes are available
+        """
+        return max(n - self.tokens, 0) / float(self.rate)
+
+    def wait(self, n, callback, call_later):
+        """Call a callback when n bytes are available
+
+        Callbacks waiting at the same time are called together, and
+        the available bytes are shared among them.  Call_later is an
+        implementation's ``call_later`` method.
+        """
+        waiting = self._waiting
+        waiting.append(callback)
+        if len(waiting) == 1:
+            call_later(self.delay(n), self._refilled)
+
+    def _refilled(self):
+        waiting = self._waiting
+        self._waiting = []
+        if len(waiting) > 1:
+            self.share = max(
+                self.available(time.time()) // len(waiting), 1)
+        else:
+            self.share = None
+        for callback in waiting:
+            callback()
+
+    def current_rate(self, now=None):
+        if now is None:
+            now = time.time()
+        samples = self._samples
+        if now - samples[1][0] >= 1.0:
+            samples[:] = samples[1], (now, self.total)
+        start, total = samples[0]
+        if now <= start:
+            return 0.0
+        return (self.total - total) / (now - start)
+
 class Inline(Implementation):
     """Run in an application thread, rather than a separate thread.
     """
@@ -208,8 +847,13 @@ class Inline(Implementation):
     def wait(self, *args):
         self.loop(*args)
 
+_connection_ids = itertools.count(1)
+
 class dispatcher(asyncore.dispatcher):
 
+    # Connection id, used in traces.
+    id = None
+
     def __init__(self, sock, addr, implementation):
         self.addr = addr
         self.implementation = implementation
@@ -218,6 +862,11 @@ class dispatcher(asyncore.dispatcher):
     def handle_error(self):
         reason = sys.exc_info()[1]
         self.logger.exception('handle_error')
+        trace = self.implementation.trace
+        if trace is not None and self.id is not None:
+            trace.record(self.id, 'error', repr(reason))
+            self.logger.error("Recent events for connection %s:\n%s",
+                              self.id, trace.format(self.id))
         try:
             self.handle_close(reason)
         except:
@@ -242,9 +891,30 @@ class _ConnectionDispatcher(dispatcher):
     _connection = None
 
     def __init__(self, sock, addr, logger, implementation):
+        # Output is queued by priority.  __output is the queue for the
+        # default priority, 0, and __queues is a list of (priority,
+        # queue) for all priorities, highest first.  Both are None
+        # when the connection is closed.
         self.__output = []
+        self.__queues = [(0, self.__output)]
+        # The ids of queues waiting for producers to resume them.
+        self.__paused = set()
+        self.id = _connection_ids.next()
         dispatcher.__init__(self, sock, addr, implementation)
         self.logger = logger
+        self.output_sent = self.opened = time.time()
+        implementation.connections_opened += 1
+        implementation.start_output_checks()
+        if implementation.tcp_sample_interval:
+            implementation._schedule_tcp_sampling()
+        trace = implementation.trace
+        if trace is not None:
+            trace.record(self.id, self.trace_open_event, addr)
+        if isinstance(sock, ssl.SSLSocket):
+            # Start with a write event to begin the handshake.
+            self.__tls = True
+            self.__handshake = ssl.SSL_ERROR_WANT_WRITE
+            self.__handshake_start = time.time()
 
     def __nonzero__(self):
         return self.__output is not None
@@ -276,28 +946,222 @@ class _ConnectionDispatcher(dispatcher):
                       DeprecationWarning, stacklevel=2)
         self.set_handler(handler)
 
-    def write(self, data):
+    def __queue(self, priority):
+        if not priority:
+            return self.__output
+        queues = self.__queues
+        if queues is None:
+            return None
+        for p, queue in queues:
+            if p == priority:
+                return queue
+        with self.implementation._output_lock:
+            # Look again, as another thread may have added the queue
+            # or closed the connection.
+            queues = self.__queues
+            if queues is None:
+                return None
+            for p, queue in queues:
+                if p == priority:
+                    return queue
+            queue = []
+            # Replace, rather than modify, the list, as the loop thread
+            # may be iterating over it.
+            self.__queues = sorted(queues + [(priority, queue)],
+                                   key=lambda item: -item[0])
+        return queue
+
+    def write(self, data, callback=None, priority=0):
         if __debug__:
             self.logger.debug('write %r', data)
         assert isinstance(data, str) or (data is zc.ngi.END_OF_DATA)
         try:
-            self.__output.append(data)
+            output = self.__queue(priority)
+            output.append(data)
+            if callback is not None:
+                output.append(_Notify(callback))
         except AttributeError:
             if self.__output is None:
                 raise ValueError("write called on closed connection")
             raise
+        if data is not zc.ngi.END_OF_DATA:
+            self.__add_output(len(data))
         self.implementation.notify_select()
 
-    def writelines(self, data):
+    def enqueue(self, data, priority=0):
+        """Queue output from the implementation's thread
+
+        Unlike write, this doesn't wake the loop, as it's running.
+        """
+        output = self.__queue(priority)
+        if output is not None:
+            output.append(data)
+            self.__add_output(len(data))
+
+    # Output accounting. Data from producers are counted once
+    # they've been produced.
+
+    __output_bytes = 0
+    __output_checking = __output_signaled = False
+
+    # Output limits, in addition to the implementation's. The output
+    # policy is one of 'close', 'drop' (queued output), or 'signal'
+    # (call the handler's handle_exception with an OutputBacklog
+    # exception).
+    output_limit = None
+    output_policy = stall_timeout = None
+
+    def output_size(self):
+        """Return the number of bytes of output buffered
+        """
+        return self.__output_bytes
+
+    def __add_output(self, n):
+        implementation = self.implementation
+        with implementation._output_lock:
+            if self.__queues is None:
+                # Closed, in which case the output was discarded.
+                if n > 0:
+                    return
+                n = -self.__output_bytes
+            if not self.__output_bytes:
+                # Time stalls from when there's output to send.
+                self.output_sent = time.time()
+            self.__output_bytes += n
+            implementation.output_bytes += n
+        if n > 0 and not self.__output_checking and (
+            (self.output_limit is not None and
+             self.__output_bytes > self.output_limit) or
+            (implementation.max_output is not None and
+             implementation.output_bytes > implementation.max_output)
+            ):
+            self.__output_checking = True
+            implementation.call_from_thread(self.__check_output_now)
+
+    def __check_output_now(self):
+        self.__output_checking = False
+        self.check_output(time.time(), self.implementation.output_share())
+
+    def check_output(self, now, share):
+        """Apply the output policy if output limits are exceeded
+
+        This is called from the implementation thread with the
+        current time and the connection's share of the
+        implementation's max_output, if it's exceeded.
+        """
+        size = self.__output_bytes
+        if not (size and self):
+            return
+        implementation = self.implementation
+        stall_timeout = self.stall_timeout
+        if stall_timeout is None:
+            stall_timeout = implementation.stall_timeout
+        if self.output_limit is not None and size > self.output_limit:
+            reason = 'output limit exceeded'
+        elif share is not None and size > share:
+            reason = 'output share exceeded'
+        elif (stall_timeout is not None and
+              now - self.output_sent > stall_timeout):
+            reason = 'output stalled'
+        else:
+            return
+
+        policy = self.output_policy or implementation.output_policy
+        if policy == 'signal' and self.__handler is not None:
+            if self.__output_signaled:
+                return # Once until the backlog is sent.
+            self.__output_signaled = True
+        else:
+            if policy != 'drop':
+                policy = 'close'
+        implementation.output_limit_exceeded += 1
+        self.logger.warning("%s for %r with %s bytes buffered: %s",
+                            reason, self.addr, size, policy)
+        if policy == 'drop':
+            self.__drop_output()
+        elif policy == 'signal':
+            try:
+                self.__handler.handle_exception(
+                    self._connection,
+                    zc.ngi.interfaces.OutputBacklog(reason, size))
+            except:
+                self.logger.exception("handle_exception failed")
+                self.handle_close(reason)
+        else:
+            self.handle_close(reason)
+
+    def __drop_output(self):
+        # Discard queued data, keeping END_OF_DATA.  Data partly sent
+        # are kept, to finish what the peer is receiving.  Callbacks
+        # for data that are dropped aren't called, as when the
+        # connection is closed, so callbacks are only kept if they
+        # come before the first data dropped from their queues.
+        dropped = 0
+        for priority, output in self.__queues:
+            kept = []
+            dropping = False
+            for v in output:
+                if v.__class__ is str:
+                    dropped += len(v)
+                    dropping = True
+                elif v.__class__ is tuple:
+                    dropped += sum(map(len, v))
+                    dropping = True
+                elif v is zc.ngi.END_OF_DATA:
+                    kept.append(v)
+                elif v.__class__ is _Notify:
+                    if not dropping:
+                        kept.append(v)
+                else:
+                    dropping = True
+                    close = getattr(v, 'close', None)
+                    if close is not None:
+                        close()
+            output[:] = kept
+        self.__paused.clear()
+        self.__add_output(-dropped)
+
+    def set_output_policy(self, limit=None, policy=None, stall_timeout=None):
+        self.output_limit = limit
+        self.output_policy = policy
+        self.stall_timeout = stall_timeout
+        self.implementation.call_from_thread(
+            lambda : self.implementation.start_output_checks(True))
+
+    def writelines(self, data, callback=None, prefetch=None, priority=0):
         if __debug__:
             self.logger.debug('writelines %r', data)
         assert not isinstance(data, str), "writelines does not accept strings"
-        try:
-            self.__output.append(iter(data))
-        except AttributeError:
-            if self.__output is None:
-                raise ValueError("writelines called on closed connection")
-            raise
+        # Check for a closed connection before starting a prefetching
+        # thread that nothing would stop.
+        output = self.__queue(priority)
+        if output is None:
+            raise ValueError("writelines called on closed connection")
+        size = None
+        if data.__class__ is tuple and not [
+            v for v in data if v.__class__ is not str]:
+            # Tuples of strings are queued as they are, so the strings
+            # are sent together without copying them.
+            size = sum(map(len, data))
+        elif getattr(data, 'more', None) is None:
+            if prefetch:
+                data = _PrefetchingProducer(
+                    iter(data), prefetch,
+                    lambda : self.implementation.call_from_thread(
+                        lambda : self.__resume(output)))
+            else:
+                data = _IteratorProducer(iter(data))
+        output.append(data)
+        if callback is not None:
+            output.append(_Notify(callback))
+        if self.__queues is None:
+            # Closed while we were adding the data.
+            close = getattr(data, 'close', None)
+            if close is not None:
+                close()
+            raise ValueError("writelines called on closed connection")
+        if size:
+            self.__add_output(size)
         self.implementation.notify_select()
 
     def close_after_write(self):
@@ -309,23 +1173,252 @@ class _ConnectionDispatcher(dispatcher):
             raise
         self.implementation.notify_select()
 
+    # The event traced when connections are opened.
+    trace_open_event = 'connect'
+    __close_reason = 'closed'
+
     def close(self):
-        self.__output = None
+        with self.implementation._output_lock:
+            queues = self.__queues
+            self.__output = self.__queues = None
+        if queues is not None:
+            self.implementation.connections_closed += 1
+            trace = self.implementation.trace
+            if trace is not None:
+                trace.record(self.id, 'close', self.__close_reason)
+        self.__add_output(0)
+        for priority, output in queues or ():
+            for v in output:
+                close = getattr(v, 'close', None)
+                if close is not None:
+                    close()
         dispatcher.close(self)
         self.implementation.notify_select()
 
+    # Statistics. See zc.ngi.stats.
+    counters = (
+        'bytes_read', 'bytes_written', 'sends', 'send_eagain',
+        'partial_writes',
+        )
+    bytes_read = bytes_written = sends = send_eagain = partial_writes = 0
+
+    def stats(self):
+        result = dict((name, getattr(self, name)) for name in self.counters)
+        result.update(
+            output_bytes=self.__output_bytes,
+            age=time.time() - self.opened,
+            )
+        if self.tcp_info:
+            for name, value in self.tcp_info.items():
+                if name != 'output_bytes':
+                    result['tcp_' + name] = value
+        return result
+
+    # When input was last read.
+    last_read = 0
+
+    def snapshot(self):
+        """Return a dictionary describing the connection
+
+        In addition to statistics, there are the connection id, peer
+        address, idle time and handler.  Adapters are shown wrapping
+        the handlers they adapt for.  This must be called from the
+        implementation thread.
+        """
+        result = self.stats()
+        handler = self.__handler
+        adapters = []
+        while isinstance(handler, zc.ngi.adapters.Base):
+            adapters.append(handler.__class__.__name__)
+            handler = handler.handler
+        result.update(
+            id=self.id,
+            peer=self.addr,
+            idle=time.time() - max(self.last_read, self.output_sent),
+            handler=''.join(name + '(' for name in adapters) +
+                    handler.__class__.__name__ + ')' * len(adapters),
+            )
+        return result
+
+    # The last sample of TCP information, or None.
+    tcp_info = None
+
+    def sample_tcp_info(self):
+        info = tcp_info(self.socket)
+        if info is not None:
+            info['output_bytes'] = self.__output_bytes
+        self.tcp_info = info
+        return info
+
+    # Token buckets limiting bytes read and written, and whether
+    # reading or writing is waiting for them to refill.
+    __read_limits = __write_limits = ()
+    __read_blocked = __write_blocked = False
+
+    def set_limits(self, read, write):
+        """Set sequences of token buckets that limit input and output
+        """
+        self.__read_limits = read
+        self.__write_limits = write
+
+    def __allowed(self, limits):
+        now = time.time()
+        allowed = None
+        for bucket in limits:
+            available = bucket.available(now)
+            share = bucket.share
+            if share is not None and share < available:
+                available = share
+            if allowed is None or available < allowed:
+                allowed = available
+        return allowed
+
+    def __consume(self, limits, n, unblock):
+        # Use tokens and, if they're low, wait for them to refill.
+        # Returns whether we're blocked.
+        now = time.time()
+        for bucket in limits:
+            bucket.consume(n, now)
+        quantum = min(min(bucket.burst for bucket in limits), BUFFER_SIZE)
+        if min(bucket.available(now) for bucket in limits) >= quantum:
+            return False
+        return self.__wait(limits, quantum, unblock)
+
+    def __wait(self, limits, n, unblock):
+        # Wait for n bytes to be available, from the bucket that will
+        # take longest to refill.  Other connections waiting for it
+        # are unblocked at the same time.
+        bucket = max(limits, key=lambda bucket: bucket.delay(n))
+        bucket.wait(n, unblock, self.implementation.call_later)
+        return True
+
+    def __unblock_reads(self):
+        self.__read_blocked = False
+        if self.__tls and self and self.socket.pending():
+            self.__read_pending()
+
+    def __unblock_writes(self):
+        self.__write_blocked = False
+
     def readable(self):
-        return self.__handler is not None
+        if self.__handshake:
+            return self.__handshake == ssl.SSL_ERROR_WANT_READ
+        return self.__handler is not None and not self.__read_blocked
 
+    __unsent = () # Strings taken from queues but not yet sent
     def writable(self):
-        return bool(self.__output)
+        if self.__handshake:
+            return self.__handshake == ssl.SSL_ERROR_WANT_WRITE
+        if self.__write_blocked:
+            return False
+        if self.__unsent:
+            return True
+        paused = self.__paused
+        for priority, output in self.__queues or ():
+            if output and id(output) not in paused:
+                return True
+        return False
+
+    def __next_output(self):
+        # Return the highest-priority queue with output to send.
+        # END_OF_DATA is only acted on once other queues are empty.
+        end = None
+        paused = self.__paused
+        waiting = False
+        for priority, output in self.__queues or ():
+            if output:
+                if output[0] is zc.ngi.END_OF_DATA:
+                    if end is None:
+                        end = output
+                elif id(output) in paused:
+                    waiting = True
+                else:
+                    return output
+        if not waiting:
+            return end
+
+    # When handshaking, the SSL error code for what the TLS handshake
+    # is waiting for.
+    __tls = False
+    tls_handshake_time = None
+    __handshake = None
+    def __do_handshake(self):
+        sock = self.socket
+        try:
+            sock.do_handshake()
+        except ssl.SSLError, err:
+            if err.args[0] in (ssl.SSL_ERROR_WANT_READ,
+                               ssl.SSL_ERROR_WANT_WRITE):
+                self.__handshake = err.args[0]
+                return
+            self.implementation.tls_handshake_failures += 1
+            raise
+        except:
+            self.implementation.tls_handshake_failures += 1
+            raise
+
+        self.__handshake = None
+        self.tls_handshake_time = time.time() - self.__handshake_start
+        self.implementation.tls_handshake_done(
+            self.tls_handshake_time, getattr(sock, 'session_reused', False))
+        if __debug__:
+            self.logger.debug('TLS handshake done %r %r',
+                              self.addr, self.tls_handshake_time)
+        if tls_sessions_supported and not sock.server_side:
+            self.implementation.tls_sessions[self.addr] = sock.session
+
+    def __resume(self, output):
+        self.__paused.discard(id(output))
 
     def handle_read_event(self):
+        if self.__handshake:
+            return self.__do_handshake()
+
         assert self.readable()
 
+        budget = self.implementation.read_budget
+        limits = self.__read_limits
+        if limits:
+            allowed = self.__allowed(limits)
+            if allowed < 1:
+                # Another connection used the tokens of a shared
+                # bucket.  Reading 0 bytes would look like the end of
+                # input, so wait.
+                self.__read_blocked = self.__wait(
+                    limits, 1, self.__unblock_reads)
+                return
+            if budget is None or allowed < budget:
+                budget = allowed
+        read = [0]
+        try:
+            if self.implementation.coalesce_reads:
+                return self.__read_coalesced(budget, read)
+            return self.__read(budget, read)
+        finally:
+            if read[0]:
+                self.last_read = time.time()
+                self.bytes_read += read[0]
+                self.implementation.bytes_read += read[0]
+                trace = self.implementation.trace
+                if trace is not None:
+                    trace.record(self.id, 'read', read[0])
+                if limits:
+                    self.__read_blocked = self.__consume(
+                        limits, read[0], self.__unblock_reads)
+
+    def __read(self, budget, read):
+        size = BUFFER_SIZE
         while 1:
+            if budget is not None and budget < size:
+                size = budget
             try:
-                d = self.recv(BUFFER_SIZE)
+                d = self.recv(size)
+            except ssl.SSLError, err:
+                # SSL error codes overlap errno values, so check them first.
+                if err.args[0] in (ssl.SSL_ERROR_WANT_READ,
+                                   ssl.SSL_ERROR_WANT_WRITE):
+                    return
+                raise
             except socket.error, err:
                 if err[0] in expected_socket_read_errors:
                     return
@@ -334,87 +1427,315 @@ class _ConnectionDispatcher(dispatcher):
             if not d:
                 return
 
+            read[0] += len(d)
             if __debug__:
                 self.logger.debug('input %r', d)
+            timing = self.__timing
             try:
-                self.__handler.handle_input(self._connection, d)
+                if timing is None:
+                    self.__handler.handle_input(self._connection, d)
+                else:
+                    self.__timed_input(timing, d)
             except:
                 self.logger.exception("handle_input failed")
                 raise
 
-            if len(d) < BUFFER_SIZE:
+            if len(d) < size and not (
+                self.__tls and self.socket.pending()):
+                # Decrypted TLS data may be buffered without the
+                # socket being readable, so we read that too.
+                break
+
+            if budget is not None:
+                budget -= len(d)
+                if budget <= 0:
+                    self.__read_next_pass()
+                    break
+
+    # Request timing. When enabled, __timing is a zc.ngi.stats.Timing
+    # and __input_time is when input arrived that hasn't been
+    # completely responded to.
+    __timing = __input_time = None
+    __first_sent = False
+
+    def set_timing(self, timing):
+        self.__timing = timing
+        self.__input_time = None
+        self.__first_sent = False
+
+    def __timed_input(self, timing, data):
+        start = time.time()
+        if self.__input_time is None:
+            self.__input_time = start
+        try:
+            self.__handler.handle_input(self._connection, data)
+        finally:
+            timing.handler.record(time.time() - start)
+
+    def __response_sent(self):
+        # Record the time from input to the first and last bytes of
+        # the response.  The response is complete when there's
+        # nothing left to send.
+        now = time.time()
+        elapsed = now - self.__input_time
+        timing = self.__timing
+        if not self.__first_sent:
+            self.__first_sent = True
+            timing.first_byte.record(elapsed)
+        if not self.__unsent:
+            for priority, output in self.__queues or ():
+                if output:
+                    return
+            timing.last_byte.record(elapsed)
+            self.__input_time = None
+            self.__first_sent = False
+
+    def __read_next_pass(self):
+        # We stopped reading because we exhausted our budget. If the
+        # socket is readable, we'll be called again by select.
+        # Decrypted TLS data aren't visible to select, though.
+        if self.__tls and self.socket.pending():
+            self.implementation.call_next_pass(self.__read_pending)
+
+    def __read_pending(self):
+        if self and self.readable():
+            self.handle_read_event()
+
+    def __read_coalesced(self, budget, read):
+        # Read up to the implementation's coalesce_reads bytes into
+        # its read buffer and pass them to the handler in one call.
+        view = self.implementation.read_buffer()
+        limit = len(view)
+        if budget is not None:
+            limit = min(limit, budget)
+        recv_into = self.socket.recv_into
+        while 1:
+            pos = 0
+            closed = False
+            while pos < limit:
+                try:
+                    n = recv_into(view[pos:], limit - pos)
+                except ssl.SSLError, err:
+                    if err.args[0] in (ssl.SSL_ERROR_WANT_READ,
+                                       ssl.SSL_ERROR_WANT_WRITE):
+                        break
+                    raise
+                except socket.error, err:
+                    if err[0] in expected_socket_read_errors:
+                        break
+                    if err[0] in asyncore._DISCONNECTED:
+                        closed = True
+                        break
+                    raise
+                if not n:
+                    closed = True
+                    break
+                pos += n
+
+            if pos:
+                read[0] += pos
+                d = view[:pos].tobytes()
+                if __debug__:
+                    self.logger.debug('input %r', d)
+                timing = self.__timing
+                try:
+                    if timing is None:
+                        self.__handler.handle_input(self._connection, d)
+                    else:
+                        self.__timed_input(timing, d)
+                except:
+                    self.logger.exception("handle_input failed")
+                    raise
+
+            if closed:
+                return self.handle_close()
+
+            if pos < limit:
+                break
+
+            if budget is not None:
+                budget -= pos
+                if budget <= 0:
+                    return self.__read_next_pass()
+
+            if not (self.__tls and self.socket.pending()):
                 break
 
     def handle_write_event(self):
         if __debug__:
             self.logger.debug('handle_write_event')
 
+        if self.__handshake:
+            return self.__do_handshake()
+
+        limits = self.__write_limits
+        if limits:
+            allowed = self.__allowed(limits)
+            if allowed < 1:
+                self.__write_blocked = self.__wait(
+                    limits, 1, self.__unblock_writes)
+                return
+
         tosend = []
         nsend = 0
-        send_size = 60000
-        output = self.__output
+        unsent = self.__unsent
+        if unsent:
+            # A partial send must be finished before anything else.
+            self.__unsent = ()
+            tosend.extend(unsent)
+            nsend = sum(map(len, unsent))
+        send_size = SEND_SIZE
+        budget = self.implementation.write_budget
+        if limits:
+            if budget is None or allowed < budget:
+                budget = allowed
+        sent = 0
         try:
-            while output:
-                v = output[0]
-                if v is zc.ngi.END_OF_DATA:
-                    if not nsend:
-                        self.close()
-                        return
-                    send_size = 0
-                elif isinstance(v, str):
-                    tosend.append(v)
-                    nsend += len(v)
-                    output.pop(0)
-                else:
-                    # Must be an iterator
-                    try:
-                        v = v.next()
-                        if not isinstance(v, str):
-                            raise TypeError(
-                                "writelines iterator must return strings", v)
-                    except StopIteration:
-                        # all done
-                        output.pop(0)
-                    except Exception, v:
-                        self.logger.exception("writelines iterator failed")
-                        if self.__handler is None:
-                            self.__iterator_exception = v
+            while 1:
+                output = self.__next_output()
+                if output is not None and nsend < send_size:
+                    v = output[0]
+                    if v is zc.ngi.END_OF_DATA:
+                        if not nsend:
+                            self.close()
+                            return
+                        send_size = 0
+                    elif v.__class__ is _Notify:
+                        if nsend:
+                            # Send what we have before notifying
+                            send_size = 0
                         else:
-                            self.__handler.handle_exception(self._connection, v)
-                        raise
-                    else:
+                            output.pop(0)
+                            try:
+                                v.callback()
+                            except:
+                                self.logger.exception("write callback failed")
+                                raise
+                    elif isinstance(v, str):
                         tosend.append(v)
                         nsend += len(v)
-
-                if output and nsend < send_size:
+                        output.pop(0)
+                    elif v.__class__ is tuple:
+                        tosend.extend(v)
+                        nsend += sum(map(len, v))
+                        output.pop(0)
+                    else:
+                        # Must be a producer
+                        try:
+                            v = v.more(send_size - nsend)
+                            if v is None:
+                                # The producer isn't ready. It will
+                                # resume us.
+                                self.__paused.add(id(output))
+                            elif not isinstance(v, str):
+                                raise TypeError(
+                                    "producers must return strings", v)
+                        except Exception, v:
+                            self.logger.exception("writelines iterator failed")
+                            if self.__handler is None:
+                                self.__iterator_exception = v
+                            else:
+                                self.__handler.handle_exception(
+                                    self._connection, v)
+                            raise
+                        if v:
+                            tosend.append(v)
+                            nsend += len(v)
+                            self.__add_output(len(v))
+                        elif v is not None:
+                            # all done
+                            output.pop(0)
                     continue
 
-                v = ''.join(tosend)
+                if not nsend or self.__queues is None:
+                    return
+
+                # Join small strings, but send large ones by themselves,
+                # rather than copying them.
+                for i, v in enumerate(tosend):
+                    if len(v) >= SEND_SIZE:
+                        break
+                else:
+                    i = len(tosend)
+                if i > 1:
+                    v = ''.join(tosend[:i])
+                else:
+                    i = 1
+                    v = tosend[0]
+                rest = tosend[i:]
+                chunk = v
+                if budget is not None and budget < len(v):
+                    # TLS requires retries to be at least as large as
+                    # the failed attempt.
+                    chunk = v[:max(budget, self.__retry_size)]
+                implementation = self.implementation
+                self.sends += 1
+                implementation.sends += 1
                 try:
-                    n = self.send(v)
+                    n = self.send(chunk)
+                except ssl.SSLError, err:
+                    if err.args[0] in (ssl.SSL_ERROR_WANT_READ,
+                                       ssl.SSL_ERROR_WANT_WRITE):
+                        self.__retry_size = len(chunk)
+                        self.send_eagain += 1
+                        implementation.send_eagain += 1
+                        if implementation.trace is not None:
+                            implementation.trace.record(self.id, 'eagain')
+                        return # we couldn't write anything
+                    raise
                 except socket.error, err:
                     if err[0] in expected_socket_write_errors:
+                        self.send_eagain += 1
+                        implementation.send_eagain += 1
+                        if implementation.trace is not None:
+                            implementation.trace.record(self.id, 'eagain')
                         return # we couldn't write anything
                     raise
                 except Exception, v:
                     self.logger.exception("send failed")
                     raise
 
-                if n == nsend:
-                    nsend = 0
-                    del tosend[:]
-                else:
-                    nsend -= n
-                    tosend[:] = v[n:],
+                self.__retry_size = 0
+                sent += n
+                send_size = SEND_SIZE
+                if n < len(v):
+                    rest.insert(0, v[n:])
+                tosend[:] = rest
+                nsend = sum(map(len, rest))
+                if n < len(chunk):
+                    self.partial_writes += 1
+                    implementation.partial_writes += 1
                     return # can't send any more
+                if budget is not None:
+                    budget -= n
+                    if budget <= 0:
+                        # Leave the rest for the next pass.
+                        return
         finally:
             if nsend:
-                output[0:0] = tosend
-
+                self.__unsent = tosend
+            if limits and sent:
+                self.__write_blocked = self.__consume(
+                    limits, sent, self.__unblock_writes)
+            if sent:
+                self.bytes_written += sent
+                self.implementation.bytes_written += sent
+                trace = self.implementation.trace
+                if trace is not None:
+                    trace.record(self.id, 'write', sent)
+                self.output_sent = time.time()
+                self.__add_output(-sent)
+                if not self.__output_bytes:
+                    self.__output_signaled = False
+                if self.__input_time is not None:
+                    self.__response_sent()
+
+    __retry_size = 0
 
     def handle_close(self, reason='end of input'):
         if __debug__:
             self.logger.debug('close %r', reason)
+        self.__close_reason = reason
         if self.__handler is not None:
             try:
                 self.__handler.handle_close(self._connection, reason)
@@ -431,8 +1752,119 @@ class _ConnectionDispatcher(dispatcher):
     def __hash__(self):
         return hash(self.socket)
 
+class _Notify:
+    """Output marker for a callback to be called once prior data is sent
+    """
+
+    def __init__(self, callback):
+        self.callback = callback
+
+class _IteratorProducer:
+    """Adapt a writelines iterator to the producer interface
+    """
+
+    def __init__(self, iterator):
+        self.next = iterator.next
+
+    def more(self, max_bytes):
+        next = self.next
+        data = []
+        n = 0
+        try:
+            while n < max_bytes:
+                v = next()
+                if not isinstance(v, str):
+                    raise TypeError(
+                        "writelines iterator must return strings", v)
+                data.append(v)
+                n += len(v)
+        except StopIteration:
+            pass
+        return ''.join(data)
+
+class _PrefetchingProducer:
+    """Iterate in a separate thread, buffering data ahead of sending
+
+    This keeps expensive iterators from blocking the loop.
+    """
+
+    def __init__(self, iterator, limit, resume):
+        self.iterator = iterator
+        self.limit = limit
+        self.resume = resume
+        self.condition = threading.Condition()
+        self.chunks = []
+        self.size = 0
+        self.done = self.closed = self.waiting = False
+        self.exception = None
+        thread = threading.Thread(target=self.run,
+                                  name='zc.ngi.async prefetch')
+        thread.setDaemon(True)
+        thread.start()
+
+    def run(self):
+        condition = self.condition
+        try:
+            for data in self.iterator:
+                if not isinstance(data, str):
+                    raise TypeError(
+                        "writelines iterator must return strings", data)
+                with condition:
+                    while self.size >= self.limit and not self.closed:
+                        condition.wait()
+                    if self.closed:
+                        return
+                    self.chunks.append(data)
+                    self.size += len(data)
+                    waiting = self.waiting
+                    self.waiting = False
+                if waiting:
+                    self.resume()
+        except Exception, v:
+            with condition:
+                self.exception = v
+                waiting = self.waiting
+                self.waiting = False
+        else:
+            with condition:
+                self.done = True
+                waiting = self.waiting
+                self.waiting = False
+        if waiting:
+            self.resume()
+
+    def more(self, max_bytes):
+        with self.condition:
+            chunks = self.chunks
+            if chunks:
+                n = 0
+                for i, data in enumerate(chunks):
+                    n += len(data)
+                    if n >= max_bytes:
+                        i += 1
+                        break
+                else:
+                    i = len(chunks)
+                self.chunks = chunks[i:]
+                self.size -= n
+                self.condition.notify()
+                return ''.join(chunks[:i])
+            if self.exception is not None:
+                raise self.exception
+            if self.done:
+                return ''
+            self.waiting = True
+            return None
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
 class _ServerConnectionDispatcher(_ConnectionDispatcher):
 
+    trace_open_event = 'accept'
+
     def __init__(self, control, *args):
         self.control = control
         _ConnectionDispatcher.__init__(self, *args)
@@ -447,6 +1879,8 @@ class _Connection:
     def __init__(self, dispatcher):
         self._dispatcher = dispatcher
         dispatcher._connection = self
+        self.write = dispatcher.write
+        self.writelines = dispatcher.writelines
 
     def __nonzero__(self):
         return bool(self._dispatcher)
@@ -459,15 +1893,14 @@ class _Connection:
                       DeprecationWarning, stacklevel=2)
         self.set_handler(handler)
 
-    def write(self, data):
-        write = self._dispatcher.write
-        self.write = write
-        write(data)
+    # Note that write and writelines are usually bound to the
+    # dispatcher's methods when the connection is created.
+
+    def write(self, data, callback=None, priority=0):
+        self._dispatcher.write(data, callback, priority)
 
-    def writelines(self, data):
-        writelines = self._dispatcher.writelines
-        self.writelines = writelines
-        writelines(data)
+    def writelines(self, data, callback=None, prefetch=None, priority=0):
+        self._dispatcher.writelines(data, callback, prefetch, priority)
 
     def close(self):
         self._dispatcher.close_after_write()
@@ -476,6 +1909,74 @@ class _Connection:
     def peer_address(self):
         return self._dispatcher.socket.getpeername()
 
+    def stats(self):
+        """Return a dictionary of the connection's statistics
+
+        In addition to the dispatcher's counters, there are the
+        number of bytes of output buffered and the connection's age,
+        in seconds.
+        """
+        return self._dispatcher.stats()
+
+    @property
+    def counters(self):
+        return self._dispatcher.counters
+
+    @property
+    def tcp_info(self):
+        """The last sample of the connection's TCP information, or None
+
+        See the implementation ``start_tcp_sampling`` method.
+        """
+        return self._dispatcher.tcp_info
+
+    # Histograms of request handling times, or None.
+    timing = None
+
+    def set_timing(self, timing=None):
+        """Time requests, recording times in a zc.ngi.stats.Timing
+
+        The time handlers take to handle input, and the times from
+        input arriving to the first and last bytes of the response
+        being sent, are recorded.  A response is complete when the
+        connection has nothing left to send.  Pass None to stop
+        timing.
+        """
+        self.timing = timing
+        self._dispatcher.implementation.call_from_thread(
+            lambda : self._dispatcher.set_timing(timing))
+
+    # TokenBuckets limiting this connection's input and output.
+    read_limit = write_limit = None
+
+    def set_output_policy(self, limit=None, policy=None, stall_timeout=None):
+        """Set what's done when this connection's output backs up
+
+        If a limit is given, it's the maximum number of bytes of
+        output that may be buffered.  The policy is one of 'close',
+        'drop' or 'signal', and defaults to the implementation's
+        output policy.  If a stall timeout is given, the policy is
+        also applied if output isn't sent for that many seconds.
+        """
+        self._dispatcher.set_output_policy(limit, policy, stall_timeout)
+
+    def set_rate_limits(self, read=None, write=None):
+        """Limit the bytes per second read from and written to the socket
+        """
+        self.read_limit = read and TokenBucket(read)
+        self.write_limit = write and TokenBucket(write)
+        self._dispatcher.implementation.call_from_thread(self._update_limits)
+
+    def _update_limits(self):
+        limits = self.read_limit, self.write_limit
+        control = getattr(self._dispatcher, 'control', None)
+        if control is not None:
+            limits += control.read_limit, control.write_limit
+        self._dispatcher.set_limits(
+            [b for b in limits[::2] if b is not None],
+            [b for b in limits[1::2] if b is not None],
+            )
+
 class _ServerConnection(_Connection):
     zc.ngi.interfaces.implements(zc.ngi.interfaces.IServerConnection)
 
@@ -503,8 +2004,9 @@ class _Connector(dispatcher):
         _CONNECT_IN_PROGRESS = (errno.EINPROGRESS,)
         _CONNECT_OK          = (0, errno.EISCONN)
 
-    def __init__(self, addr, handler, implementation):
+    def __init__(self, addr, handler, implementation, ssl_context=None):
         self.__handler = handler
+        self.__ssl_context = ssl_context
         family = get_family_from_address(addr)
         sock = socket.socket(family, socket.SOCK_STREAM)
 
@@ -553,7 +2055,11 @@ class _Connector(dispatcher):
         if __debug__:
             self.logger.debug('outgoing connected %r', self.addr)
 
-        dispatcher = _ConnectionDispatcher(self.socket, self.addr, self.logger,
+        sock = self.socket
+        if self.__ssl_context is not None:
+            sock = _wrap_tls_client(self.__ssl_context, sock, self.addr,
+                                    self.implementation.tls_sessions)
+        dispatcher = _ConnectionDispatcher(sock, self.addr, self.logger,
                                            self.implementation)
         try:
             self.__handler.connected(_Connection(dispatcher))
@@ -604,8 +2110,11 @@ class _Listener(BaseListener):
 
     logger = logging.getLogger('zc.ngi.async.server')
 
-    def __init__(self, addr, handler, implementation, thready):
+    def __init__(self, addr, handler, implementation, thready,
+                 ssl_context=None):
         self.__handler = handler
+        self._ssl_context = ssl_context
+        self._connection_rates = None
         self.__close_handler = None
         self._thready = thready
         self.__connections = set()
@@ -662,6 +2171,7 @@ class _Listener(BaseListener):
                 return
         except socket.error, msg:
             self.logger.exception("accepted failed: %s", msg)
+            self.accept_errors += 1
             return
         if __debug__:
             self.logger.debug('incoming connection %r', addr)
@@ -671,10 +2181,25 @@ class _Listener(BaseListener):
         else:
             impl = self.implementation
 
+        if self._ssl_context is not None:
+            try:
+                sock = self._ssl_context.wrap_socket(
+                    sock, server_side=True, do_handshake_on_connect=False)
+            except (ssl.SSLError, socket.error), msg:
+                self.logger.exception("TLS setup failed: %s", msg)
+                self.accept_errors += 1
+                sock.close()
+                return
+
         dispatcher = _ServerConnectionDispatcher(
             self, sock, addr, self.logger, impl)
         connection = _ServerConnection(dispatcher)
         self.__connections.add(connection)
+        self.accepted += 1
+        if self._connection_rates is not None:
+            connection.set_rate_limits(*self._connection_rates)
+        if self.timing is not None:
+            connection.set_timing(self.timing)
 
         @impl.call_from_thread
         def _():
@@ -691,9 +2216,87 @@ class _Listener(BaseListener):
     def connections(self):
         return iter(self.__connections)
 
+    # Statistics. See zc.ngi.stats.
+    counters = ('accepted', 'accept_errors', 'connections_closed')
+    accepted = accept_errors = connections_closed = 0
+
+    def stats(self):
+        result = dict((name, getattr(self, name)) for name in self.counters)
+        result['connections'] = len(self.__connections)
+        if self.timing is not None:
+            result.update(self.timing.stats())
+        if self.tcp_stats is not None:
+            result.update(self.tcp_stats)
+        return result
+
+    # Aggregated TCP information for the listener's connections, and a
+    # histogram of their RTTs, when the implementation samples it.
+    tcp_stats = tcp_rtt = None
+
+    def tcp_sampled(self, infos):
+        """Aggregate samples of connections' TCP information
+        """
+        if self.tcp_rtt is None:
+            self.tcp_rtt = zc.ngi.stats.Histogram()
+        rtts = [info['rtt'] for info in infos]
+        for rtt in rtts:
+            self.tcp_rtt.record(rtt)
+        self.tcp_stats = dict(
+            tcp_connections=len(infos),
+            tcp_max_rtt=max(rtts),
+            tcp_mean_rtt=sum(rtts) / len(rtts),
+            tcp_unacked=sum(info['unacked'] for info in infos),
+            tcp_total_retrans=sum(info['total_retrans'] for info in infos),
+            tcp_output_bytes=sum(info['output_bytes'] for info in infos),
+            tcp_rtt=self.tcp_rtt,
+            )
+
+    # Histograms of request handling times for all connections, or None.
+    timing = None
+
+    def set_timing(self, enabled=True):
+        """Time requests for all of the listener's connections
+
+        See the connection ``set_timing`` method.  Times are
+        recorded in the listener's ``timing``, replacing any previous
+        times.
+        """
+        timing = self.timing = enabled and zc.ngi.stats.Timing() or None
+
+        @self.implementation.call_from_thread
+        def _():
+            for connection in self.__connections:
+                connection.set_timing(timing)
+
+    def broadcast(self, data, max_pending=None, priority=0):
+        return self.implementation.broadcast(
+            self.__connections, data, max_pending, priority)
+
+    # TokenBuckets limiting input and output for all connections
+    read_limit = write_limit = None
+
+    def set_rate_limits(self, read=None, write=None,
+                        connection_read=None, connection_write=None):
+        """Limit bytes per second read and written
+
+        The ``read`` and ``write`` limits apply to all of the
+        listener's connections together and the ``connection_read``
+        and ``connection_write`` limits apply to each connection.
+        The limits replace those of current connections.
+        """
+        self.read_limit = read and TokenBucket(read)
+        self.write_limit = write and TokenBucket(write)
+        self._connection_rates = connection_read, connection_write
+
+        @self.implementation.call_from_thread
+        def _():
+            for connection in self.__connections:
+                connection.set_rate_limits(connection_read, connection_write)
+
     def closed(self, connection):
         if connection in self.__connections:
             self.__connections.remove(connection)
+            self.connections_closed += 1
             if not self.__connections and self.__close_handler:
                 self.__close_handler(self)
 
@@ -723,6 +2326,16 @@ class _Listener(BaseListener):
     def connect(self, handler):
         self.implementation.connect(self.address, handler)
 
+def _wrap_tls_client(context, sock, addr, sessions):
+    """Wrap a connected client socket for a non-blocking TLS handshake
+    """
+    kw = {}
+    if isinstance(addr, tuple):
+        kw['server_hostname'] = addr[0]
+    if tls_sessions_supported:
+        kw['session'] = sessions.get(addr)
+    return context.wrap_socket(sock, do_handshake_on_connect=False, **kw)
+
 class _UDPListener(BaseListener):
 
     logger = logging.getLogger('zc.ngi.async.udpserver')
@@ -888,9 +2501,13 @@ else:
 
 _select_implementation = Implementation(name=__name__)
 
+broadcast = _select_implementation.broadcast
 call_from_thread = _select_implementation.call_from_thread
+stats = _select_implementation.stats
 connect = connector = _select_implementation.connect
 listener = _select_implementation.listener
+run_in_executor = _select_implementation.run_in_executor
+run_in_process = _select_implementation.run_in_process
 start_thread = _select_implementation.start_thread
 udp = _select_implementation.udp
 udp_listener = _select_implementation.udp_listener
@@ -0,0 +1,281 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Runtime introspection of zc.ngi.async implementations
+
+A control listener serves commands, one per line, on a Unix socket.
+Responses are terminated by empty lines.  The control listener runs
+in its own implementation, so it can answer even when other
+implementations' loops are busy.  Snapshots of implementations are
+taken in their loop threads, and implementations that don't respond
+within a timeout are reported as not responding.
+"""
+import cProfile
+import json
+import pstats
+import StringIO
+import thread
+import weakref
+import zc.ngi.adapters
+import zc.ngi.async
+import zc.ngi.executor
+import zc.ngi.stats
+
+class Control:
+    """Serve introspection commands on a Unix socket
+    """
+
+    def __init__(self, address, implementation=None, timeout=5.0):
+        if implementation is None:
+            implementation = zc.ngi.async.Implementation(
+                name='zc.ngi.control')
+        self.implementation = implementation
+        self.timeout = timeout
+        self._profilers = weakref.WeakKeyDictionary()
+        self.listener = implementation.listener(address, self._connected)
+
+    def close(self):
+        self.listener.close()
+
+    def implementations(self):
+        """Return the implementations to introspect
+
+        The control listener's own implementation is excluded.
+        """
+        return [implementation
+                for implementation in zc.ngi.async.implementations()
+                if implementation is not self.implementation]
+
+    def _connected(self, connection):
+        _Session(self, connection)
+
+    def in_loops(self, func, callback):
+        """Call a function with each implementation in its loop thread
+
+        Once all of the implementations have responded, or after the
+        timeout, the callback is called from the control loop with a
+        list of implementations and futures of the function's results.
+        Futures are not done for implementations that didn't respond.
+        Implementations whose loops aren't running are called
+        directly.
+        """
+        call = self.implementation.call_from_thread
+        implementations = self.implementations()
+        futures = []
+        for implementation in implementations:
+            future = zc.ngi.executor.Future(call)
+            futures.append(future)
+            if implementation.thread_ident is None:
+                # The loop isn't running, so it's safe to call here.
+                _run(future, func, implementation)
+            else:
+                implementation.call_from_thread(
+                    lambda implementation=implementation, future=future:
+                    _run(future, func, implementation))
+
+        finished = []
+        def finish(timed_out=False):
+            if finished or not (
+                timed_out or [f for f in futures if f.done()] == futures):
+                return
+            finished.append(True)
+            timer.cancel()
+            callback(zip(implementations, futures))
+
+        timer = self.implementation.call_later(
+            self.timeout, lambda : finish(True))
+        for future in futures:
+            future.add_done_callback(lambda future: finish())
+        if not futures:
+            finish()
+
+    # Commands.  Each is called with a function for sending the
+    # response and the command's arguments.
+
+    def command_help(self, respond):
+        """help: list commands"""
+        respond('\n'.join(
+            getattr(self, name).__doc__
+            for name in sorted(dir(self)) if name.startswith('command_')))
+
+    def command_stats(self, respond):
+        """stats: statistics in the Prometheus text format"""
+        respond(zc.ngi.stats.exposition(self.implementations()))
+
+    def command_snapshot(self, respond):
+        """snapshot: implementations, listeners and connections, as JSON"""
+        def done(results):
+            respond(json.dumps(
+                [_result(implementation, future)
+                 for (implementation, future) in results],
+                default=_json_default, sort_keys=True))
+        self.in_loops(lambda implementation: implementation.snapshot(), done)
+
+    def command_connections(self, respond):
+        """connections: a table of open connections"""
+        def done(results):
+            lines = ['%6s %-20s %-24s %8s %8s %10s %10s %10s %s' % (
+                'id', 'implementation', 'peer', 'age', 'idle',
+                'read', 'written', 'output', 'handler')]
+            for implementation, future in results:
+                snapshot = _result(implementation, future)
+                if 'error' in snapshot:
+                    lines.append('%6s %-20s %s' % (
+                        '', implementation.name, snapshot['error']))
+                    continue
+                for c in snapshot['connections']:
+                    lines.append(
+                        '%6s %-20s %-24s %8.1f %8.1f %10s %10s %10s %s' % (
+                            c['id'], implementation.name, _address(c['peer']),
+                            c['age'], c['idle'], c['bytes_read'],
+                            c['bytes_written'], c['output_bytes'],
+                            c['handler']))
+            respond('\n'.join(lines))
+        self.in_loops(lambda implementation: implementation.snapshot(), done)
+
+    def command_trace(self, respond, action='dump', *args):
+        """trace on [size [sample]] | off | dump [id]: event tracing"""
+        implementations = self.implementations()
+        if action == 'on':
+            for implementation in implementations:
+                implementation.start_trace(*map(int, args))
+            respond('tracing %s implementations' % len(implementations))
+        elif action == 'off':
+            for implementation in implementations:
+                implementation.stop_trace()
+            respond('tracing stopped')
+        elif action == 'dump':
+            ident = args and int(args[0]) or None
+            respond(''.join(
+                implementation.trace.format(ident)
+                for implementation in implementations
+                if implementation.trace is not None).rstrip('\n'))
+        else:
+            raise ValueError("Unknown trace action", action)
+
+    def command_profile(self, respond, action, limit='30'):
+        """profile on | off [limit]: profile implementation loops"""
+        profilers = self._profilers
+        if action == 'on':
+            def start(implementation):
+                # Profilers profile the thread they're enabled in.
+                if implementation.thread_ident != thread.get_ident():
+                    return False
+                if implementation not in profilers:
+                    profiler = cProfile.Profile()
+                    profiler.enable()
+                    profilers[implementation] = profiler
+                return True
+            def done(results):
+                respond('profiling %s implementations' % len(
+                    [f for (i, f) in results if f.done() and f.result()]))
+            self.in_loops(start, done)
+        elif action == 'off':
+            def stop(implementation):
+                profiler = profilers.pop(implementation, None)
+                if profiler is not None:
+                    profiler.disable()
+                return profiler
+            def done(results):
+                profiles = [f.result() for (i, f) in results
+                            if f.done() and f.exception() is None
+                            and f.result() is not None]
+                if not profiles:
+                    return respond('not profiling')
+                out = StringIO.StringIO()
+                stats = pstats.Stats(profiles[0], stream=out)
+                for profile in profiles[1:]:
+                    stats.add(profile)
+                stats.sort_stats('cumulative').print_stats(int(limit))
+                respond(out.getvalue().strip('\n'))
+            self.in_loops(stop, done)
+        else:
+            raise ValueError("Unknown profile action", action)
+
+    def command_close(self, respond, ident):
+        """close id: close a connection"""
+        ident = int(ident)
+        def close(implementation):
+            return implementation.close_connection(ident, 'closed by control')
+        def done(results):
+            if [f for (i, f) in results
+                if f.done() and f.exception() is None and f.result()]:
+                respond('closed %s' % ident)
+            else:
+                respond('no connection %s' % ident)
+        self.in_loops(close, done)
+
+class _Session:
+    # Commands are run one at a time, so responses are in order.
+
+    def __init__(self, control, connection):
+        self.control = control
+        self.connection = zc.ngi.adapters.Lines(connection)
+        self.commands = []
+        self.running = False
+        self.connection.set_handler(self)
+
+    def handle_input(self, connection, line):
+        self.commands.append(line)
+        if not self.running:
+            self.next()
+
+    def handle_close(self, connection, reason):
+        self.commands = []
+
+    def next(self):
+        while self.commands:
+            words = self.commands.pop(0).split()
+            if not words:
+                continue
+            self.running = True
+            command = getattr(self.control, 'command_' + words[0], None)
+            if command is None:
+                return self.respond('error: unknown command %r' % words[0])
+            try:
+                command(self.respond, *words[1:])
+            except Exception, v:
+                self.respond('error: %s' % (v, ))
+            return
+
+    def respond(self, text):
+        self.running = False
+        if self.connection:
+            self.connection.write(text + '\n\n')
+        self.next()
+
+def _run(future, func, implementation):
+    try:
+        result = func(implementation)
+    except Exception, v:
+        future.set_exception(v)
+    else:
+        future.set_result(result)
+
+def _result(implementation, future):
+    if not future.done():
+        return dict(name=implementation.name, error='not responding')
+    if future.exception() is not None:
+        return dict(name=implementation.name, error=str(future.exception()))
+    return future.result()
+
+def _address(address):
+    if isinstance(address, tuple):
+        return '%s:%s' % address[:2]
+    return str(address)
+
+def _json_default(ob):
+    if isinstance(ob, zc.ngi.stats.Histogram):
+        return dict(count=ob.count, sum=ob.sum, max=ob.max,
+                    p50=ob.percentile(50), p99=ob.percentile(99))
+    return repr(ob)
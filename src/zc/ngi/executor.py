@@ -0,0 +1,265 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Run blocking work outside of implementation loops
+"""
+from __future__ import with_statement
+
+import cPickle
+import multiprocessing
+import Queue
+import threading
+import time
+import zc.ngi.interfaces
+
+class Future:
+    zc.ngi.interfaces.implements(zc.ngi.interfaces.IFuture)
+
+    def __init__(self, call):
+        # call is used to call callbacks, typically an
+        # implementation's call_from_thread.
+        self._call = call
+        self._condition = threading.Condition()
+        self._callbacks = []
+        self._done = False
+        self._result = self._exception = None
+
+    def done(self):
+        return self._done
+
+    def set_result(self, result):
+        self._set(result, None)
+
+    def set_exception(self, exception):
+        self._set(None, exception)
+
+    def _set(self, result, exception):
+        with self._condition:
+            if self._done:
+                raise ValueError("Future already done")
+            self._result = result
+            self._exception = exception
+            self._done = True
+            callbacks = self._callbacks
+            self._callbacks = None
+            self._condition.notifyAll()
+        for callback in callbacks:
+            self._call(lambda callback=callback: callback(self))
+
+    def add_done_callback(self, callback):
+        with self._condition:
+            if not self._done:
+                self._callbacks.append(callback)
+                return
+        self._call(lambda : callback(self))
+
+    def result(self, timeout=None):
+        self._wait(timeout)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        self._wait(timeout)
+        return self._exception
+
+    def _wait(self, timeout):
+        with self._condition:
+            if not self._done:
+                self._condition.wait(timeout)
+            if not self._done:
+                raise zc.ngi.interfaces.Timeout
+
+class Executor:
+    """Run functions in a bounded pool of threads
+
+    Threads are started as needed, up to ``size``.  Results are
+    delivered through futures whose callbacks are called using
+    ``call``.
+
+    The attributes ``queued``, ``max_queued``, ``running``,
+    ``completed``, ``wait_time`` (the total time, in seconds, that
+    completed work spent queued) and ``max_wait_time`` can be used
+    for monitoring.
+    """
+
+    queued = max_queued = running = completed = 0
+    wait_time = max_wait_time = 0.0
+
+    def __init__(self, call, size=4, name='zc.ngi.executor'):
+        self.call = call
+        self.size = size
+        self.name = name
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self._threads = 0
+        self._idle = 0
+
+    def submit(self, func, *args):
+        future = Future(self.call)
+        with self._lock:
+            self.queued += 1
+            if self.queued > self.max_queued:
+                self.max_queued = self.queued
+            if self._idle < self.queued and self._threads < self.size:
+                self._threads += 1
+                self._idle += 1
+                thread = threading.Thread(
+                    target=self._run,
+                    name="%s %s" % (self.name, self._threads))
+                thread.setDaemon(True)
+                thread.start()
+        self._queue.put((func, args, future, time.time()))
+        return future
+
+    def _run(self):
+        get = self._queue.get
+        lock = self._lock
+        while 1:
+            func, args, future, queued = get()
+            wait = time.time() - queued
+            with lock:
+                self.queued -= 1
+                self._idle -= 1
+                self.running += 1
+                self.wait_time += wait
+                if wait > self.max_wait_time:
+                    self.max_wait_time = wait
+            try:
+                result = func(*args)
+            except Exception, v:
+                future.set_exception(v)
+            else:
+                future.set_result(result)
+            with lock:
+                self.running -= 1
+                self.completed += 1
+                self._idle += 1
+
+class ProcessExecutor:
+    """Run functions in a pool of processes
+
+    This is for CPU-bound work that would otherwise hold the global
+    interpreter lock.  Functions, arguments, results and exceptions
+    must be picklable.  If they aren't, the pickling errors are set on
+    the futures.  The pool is created when first used.
+
+    The attributes ``submitted`` and ``completed`` can be used for
+    monitoring.
+    """
+
+    submitted = completed = 0
+    _pool = None
+
+    def __init__(self, call, size=None):
+        self.call = call
+        self.size = size
+        self._lock = threading.Lock()
+
+    def submit(self, func, *args):
+        future = Future(self.call)
+        # Pools don't call callbacks when pickling fails, so we pickle
+        # calls and outcomes ourselves.
+        try:
+            call = cPickle.dumps((func, args), cPickle.HIGHEST_PROTOCOL)
+        except Exception, v:
+            future.set_exception(v)
+            return future
+
+        with self._lock:
+            if self._pool is None:
+                self._pool = multiprocessing.Pool(self.size)
+            self.submitted += 1
+            pool = self._pool
+
+        def callback(outcome):
+            self.completed += 1
+            try:
+                ok, result = cPickle.loads(outcome)
+            except Exception, v:
+                ok, result = False, v
+            if ok:
+                future.set_result(result)
+            else:
+                future.set_exception(result)
+
+        pool.apply_async(_call_in_process, (call, ), callback=callback)
+        return future
+
+    @property
+    def running(self):
+        return self.submitted - self.completed
+
+    def close(self):
+        with self._lock:
+            pool = self._pool
+            self._pool = None
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+def _call_in_process(call):
+    try:
+        func, args = cPickle.loads(call)
+        outcome = True, func(*args)
+    except Exception, v:
+        outcome = False, v
+    try:
+        return cPickle.dumps(outcome, cPickle.HIGHEST_PROTOCOL)
+    except Exception, v:
+        return cPickle.dumps((False, v), cPickle.HIGHEST_PROTOCOL)
+
+class Limiter:
+    """Limit the number of outstanding calls made with a submit function
+
+    Typically, one is created per connection, so that slow requests
+    from one connection can't keep other connections from getting
+    work done::
+
+      self.limiter = Limiter(implementation.run_in_process, 2)
+      ...
+      self.limiter.submit(count, data).add_done_callback(self.counted)
+
+    Calls beyond the limit are queued and submitted as earlier
+    calls complete.  Limiters must only be used from an
+    implementation's thread.
+    """
+
+    def __init__(self, submit, limit):
+        self._submit = submit
+        self.limit = limit
+        self.outstanding = 0
+        self.pending = []
+
+    def submit(self, func, *args):
+        future = Future(lambda f: f())
+        if self.outstanding < self.limit:
+            self._start(future, func, args)
+        else:
+            self.pending.append((future, func, args))
+        return future
+
+    def _start(self, future, func, args):
+        self.outstanding += 1
+        self._submit(func, *args).add_done_callback(
+            lambda f: self._done(future, f))
+
+    def _done(self, future, inner):
+        self.outstanding -= 1
+        if self.pending:
+            self._start(*self.pending.pop(0))
+        exception = inner.exception()
+        if exception is None:
+            future.set_result(inner.result())
+        else:
+            future.set_exception(exception)
@@ -77,6 +77,14 @@ class ConnectionHandler(object):
         except StopIteration:
             connection.close()
 
+    def handle_input_batch(self, connection, data):
+        send = self.gen.send
+        try:
+            for d in data:
+                send(d)
+        except StopIteration:
+            connection.close()
+
     def handle_close(self, connection, reason):
         try:
             self.gen.throw(GeneratorExit, GeneratorExit(reason))
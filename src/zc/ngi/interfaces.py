@@ -70,6 +70,85 @@ class IImplementation(Interface):
         any time.
         """
 
+    def broadcast(connections, data, max_pending=None, priority=0):
+        """Write a string to each of a group of connections
+
+        The connections may be adapted, but the data are written to
+        the underlying connections, so they must already be framed
+        as needed, for example with ``zc.ngi.adapters.frame``.
+
+        If ``max_pending`` is given, connections that have more than
+        that many bytes of output waiting to be sent are skipped.
+
+        An ``IFuture`` is returned whose result is the number of
+        connections skipped.
+
+        This method is thread safe. It may be called by any thread at
+        any time.
+        """
+
+    def run_in_executor(func, *args):
+        """Call a function with arguments in a separate thread
+
+        Use this for blocking work, like database calls, that
+        would otherwise keep the implementation from servicing other
+        connections.
+
+        An ``IFuture`` is returned.  Callbacks registered with the
+        future are called from the implementation's thread.
+
+        This method is thread safe. It may be called by any thread at
+        any time.
+        """
+
+    def run_in_process(func, *args):
+        """Call a function with arguments in a separate process
+
+        Use this for CPU-intensive work.  The function, arguments and
+        result must be picklable.
+
+        An ``IFuture`` is returned.  Callbacks registered with the
+        future are called from the implementation's thread.
+
+        This method is thread safe. It may be called by any thread at
+        any time.
+        """
+
+class IFuture(Interface):
+    """The eventual result of a function call
+
+    This is an implementation interface.
+    """
+
+    def done():
+        """Return a boolean indicating whether the call has completed
+        """
+
+    def add_done_callback(callback):
+        """Call the callback with the future when the call is complete
+
+        If the call is already complete, the callback is called
+        right away.  Callbacks are called from the implementation's
+        thread.
+        """
+
+    def result(timeout=None):
+        """Return the result of the call
+
+        If the call raised an exception, the exception is raised.
+
+        If the call hasn't completed, wait for it.  If it doesn't
+        complete within the timeout, a ``Timeout`` is raised.  This
+        must not be called from an implementation's thread for a
+        call that hasn't completed.
+        """
+
+    def exception(timeout=None):
+        """Return the exception raised by the call, or None
+
+        Waiting is handled as for ``result``.
+        """
+
 class IConnection(Interface):
     """Network connections
 
@@ -101,21 +180,55 @@ class IConnection(Interface):
         implementation.
         """
 
-    def write(data):
+    def write(data, callback=None, priority=0):
         """Output a string to the connection.
 
         The write call is non-blocking.
 
+        Output written with a higher priority is sent before output
+        with lower priorities that hasn't been sent yet, so, for
+        example, control messages can overtake bulk data.  Strings
+        passed to ``write``, and strings returned by ``writelines``
+        iterators, are never split by higher-priority output.
+        Implementations may ignore priorities.
+
+        If a callback is passed, it will be called without arguments,
+        from the implementation's thread, once the data has been
+        handed off to the operating system.  This lets applications
+        limit the amount of data they have in flight.  The callback
+        isn't called if the connection is closed before the data is
+        sent.
+
         This method is thread safe. It may be called by any thread at
         any time.
         """
 
-    def writelines(data):
+    def writelines(data, callback=None, prefetch=None, priority=0):
         """Output an iterable of strings to the connection.
 
         The ``writelines`` call is non-blocking. Note, that the data may
         not have been consumed when the method returns.
 
+        Rather than an iterable, an ``IProducer`` may be passed.  The
+        implementation will ask the producer for data as the
+        connection is able to accept it.
+
+        If a callback is passed, it will be called without arguments,
+        from the implementation's thread, once all of the data has
+        been handed off to the operating system.
+
+        If a prefetch byte count is passed, implementations may
+        iterate over the data in a separate thread, buffering up to
+        roughly that many bytes ahead of what's been sent.  This is
+        useful for iterators that do significant computation.
+        Exceptions raised by the iterator are still reported to the
+        connection handler's ``handle_exception`` method.
+
+        The priority is as for ``write``.  Higher-priority output
+        isn't sent between the strings of a tuple of strings, so
+        strings that must be sent together can be written without
+        copying them to a single string.
+
         This method is thread safe. It may be called by any thread at
         any time.
         """
@@ -186,8 +299,32 @@ class IConnectionHandler(Interface):
 
         This method is used to recieve exceptions from an NGI
         implementation.  This will only be due to an error
-        encounted processing data passed to the connection
-        ``writelines`` methods.
+        encounted processing data (iterators or producers) passed to
+        the connection ``writelines`` methods.
+        """
+
+class IProducer(Interface):
+    """Source of output data
+
+    This is an application interface.
+
+    Producers can be passed to a connection's ``writelines`` method.
+    They're more efficient than iterators for large amounts of data,
+    because the implementation asks for as much data as it can
+    send at once.
+    """
+
+    def more(max_bytes):
+        """Return a string of roughly max_bytes bytes, or less
+
+        An empty string is returned when the producer has no more data.
+
+        If the connection is closed before the producer is exhausted,
+        the producer's ``close`` method, if it has one, is called.
+
+        If an exception is raised, it will be reported to the
+        connection's handler's ``handle_exception`` method and the
+        connection will be closed.
         """
 
 class IClientConnectHandler(Interface):
@@ -248,6 +385,12 @@ class IListener(Interface):
         """return an iterable of the current connections
         """
 
+    def broadcast(data, max_pending=None, priority=0):
+        """Write a string to each of the listener's connections
+
+        See ``IImplementation.broadcast``.
+        """
+
     def close(handler=None):
         """Close the listener and all of its connections
 
@@ -275,6 +418,14 @@ class ConnectionFailed(Exception):
     """A Connection attempt failed
     """
 
+class OutputBacklog(Exception):
+    """A connection's output has backed up
+
+    This is passed to connection handlers' ``handle_exception``
+    methods by implementations that limit buffered output.  The
+    arguments are a reason and the number of bytes buffered.
+    """
+
 class Timeout(Exception):
     """Something took too long
     """
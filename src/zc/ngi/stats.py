@@ -0,0 +1,212 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Statistics and tracing for monitoring implementations
+
+Objects that keep statistics have ``stats`` methods that return
+dictionaries of current values, and ``counters`` attributes naming
+the values that only increase.  The rest are gauges, or histograms
+of durations.
+
+Counters are plain integers, updated without locking by the threads
+that own them, so snapshots can be taken from any thread without
+blocking implementation loops.  Snapshots may be slightly out of date.
+
+Traces record recent events in fixed-size buffers, so incidents can be
+reconstructed without logging every read and write.
+"""
+
+import bisect
+import time
+
+class Histogram:
+    """Counts of values in logarithmically sized buckets
+
+    Bucket upper bounds start at ``start`` and double, so recording
+    takes constant time and memory while covering a wide range of
+    values with bounded relative error.  Values larger than the last
+    bound are counted in a final, unbounded, bucket.
+    """
+
+    def __init__(self, start=1e-5, buckets=24):
+        self.bounds = [start * (1 << i) for i in range(buckets)]
+        self.counts = [0] * (buckets + 1)
+        self.count = 0
+        self.sum = self.max = 0.0
+
+    def record(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def buckets(self):
+        """Return a list of upper bounds and cumulative counts
+
+        The last bound is infinity.
+        """
+        result = []
+        n = 0
+        for bound, count in zip(self.bounds + [float('inf')], self.counts):
+            n += count
+            result.append((bound, n))
+        return result
+
+    def percentile(self, p):
+        """Return an upper bound for the given percentile of values
+
+        The bound is the upper bound of the bucket containing the
+        percentile, or the maximum value recorded, whichever is less.
+        """
+        if not self.count:
+            return 0.0
+        n = self.count * p / 100.0
+        for bound, count in self.buckets():
+            if count >= n:
+                return min(bound, self.max)
+
+    def __repr__(self):
+        return '<Histogram count=%s sum=%s max=%s>' % (
+            self.count, self.sum, self.max)
+
+class Timing:
+    """Histograms of request handling times, in seconds
+
+    ``handler`` records the time handlers take to handle input, and
+    ``first_byte`` and ``last_byte`` record the times from input
+    arriving to the first and last bytes of responses being sent.
+    """
+
+    def __init__(self):
+        self.handler = Histogram()
+        self.first_byte = Histogram()
+        self.last_byte = Histogram()
+
+    def stats(self):
+        return dict(handler_times=self.handler,
+                    first_byte_times=self.first_byte,
+                    last_byte_times=self.last_byte)
+
+class Trace:
+    """A ring buffer of the most recent connection events
+
+    Events are tuples of a time, a connection id, an event name, such
+    as 'accept', 'read' or 'close', and a value, such as a number of
+    bytes or a close reason.  If ``sample`` is greater than 1, only
+    events for one in ``sample`` connections are recorded.
+    """
+
+    def __init__(self, size=10000, sample=1):
+        self.size = size
+        self.sample = sample
+        self.events = [None] * size
+        self.index = 0
+
+    def record(self, ident, event, value=None):
+        if ident % self.sample:
+            return
+        index = self.index
+        self.events[index % self.size] = time.time(), ident, event, value
+        self.index = index + 1
+
+    def dump(self, ident=None):
+        """Return recorded events, oldest first
+
+        If a connection id is given, only its events are returned.
+        """
+        index = self.index
+        events = self.events
+        if index > self.size:
+            start = index % self.size
+            events = events[start:] + events[:start]
+        else:
+            events = events[:index]
+        if ident is not None:
+            events = [e for e in events if e[1] == ident]
+        return events
+
+    def format(self, ident=None):
+        """Return recorded events as text, one event per line
+        """
+        return ''.join(
+            '%s.%06d %6s %-7s %s\n' % (
+                time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(t)),
+                int(t % 1 * 1000000), i, event, '' if value is None else value)
+            for (t, i, event, value) in self.dump(ident))
+
+def exposition(implementations, prefix='zc_ngi'):
+    """Return statistics in a text format that can be scraped
+
+    The format is the Prometheus text exposition format.  Statistics
+    are given for each implementation and its listeners, labeled with
+    the implementation name and listener address.
+    """
+    samples = {} # {name -> (type, [(labels, value)])}
+    for implementation in implementations:
+        labels = (('implementation', implementation.name), )
+        _add(samples, prefix, implementation, labels)
+        for listener in implementation.listeners():
+            _add(samples, prefix + '_listener', listener,
+                 labels + (('listener', listener.address), ))
+
+    lines = []
+    for name in sorted(samples):
+        kind, values = samples[name]
+        lines.append('# TYPE %s %s' % (name, kind))
+        for labels, value in values:
+            if kind == 'histogram':
+                for bound, count in value.buckets():
+                    lines.append(_sample(name + '_bucket',
+                                         labels + (('le', bound), ), count))
+                lines.append(_sample(name + '_sum', labels, value.sum))
+                lines.append(_sample(name + '_count', labels, value.count))
+            else:
+                lines.append(_sample(name, labels, value))
+    return '\n'.join(lines) + '\n'
+
+def _add(samples, prefix, ob, labels):
+    counters = ob.counters
+    for name, value in sorted(ob.stats().items()):
+        if isinstance(value, Histogram):
+            kind = 'histogram'
+        elif isinstance(value, bool) or not isinstance(
+            value, (int, long, float)):
+            continue
+        elif name in counters:
+            kind = 'counter'
+            name += '_total'
+        else:
+            kind = 'gauge'
+        samples.setdefault(prefix + '_' + name, (kind, []))[1].append(
+            (labels, value))
+
+def _sample(name, labels, value):
+    return '%s{%s} %s' % (
+        name,
+        ','.join('%s="%s"' % (label, _escape(v)) for (label, v) in labels),
+        _format(value))
+
+def _format(value):
+    if not isinstance(value, float):
+        return str(value)
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value)
+
+def _escape(value):
+    if isinstance(value, float):
+        value = _format(value)
+    elif not isinstance(value, basestring):
+        value = str(value)
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
@@ -18,10 +18,14 @@ import sys
 import traceback
 import warnings
 import zc.ngi
+import zc.ngi.adapters
+import zc.ngi.executor
 import zc.ngi.interfaces
 
 zc.ngi.interfaces.moduleProvides(zc.ngi.interfaces.IImplementation)
 
+PRODUCER_SIZE = 1 << 16
+
 class PrintingHandler:
 
     def __init__(self, connection):
@@ -120,9 +124,6 @@ class Connection:
         if self.control is not None:
             self.control.closed(self)
         self.closed = True
-        def write(s):
-            raise TypeError("Connection closed")
-        self.write = write
 
     def set_handler(self, handler):
         self.handler = handler
@@ -143,7 +144,12 @@ class Connection:
     def _exception(self, exception):
         self._callHandler('handle_exception', exception)
 
-    def write(self, data):
+    def write(self, data, callback=None, priority=0):
+        # Check here, rather than replacing the method on close, as
+        # adapters bind to the method when they're created.
+        if self.closed:
+            raise TypeError("Connection closed")
+
         if data is zc.ngi.END_OF_DATA:
             return self.close()
 
@@ -152,9 +158,16 @@ class Connection:
         else:
             raise TypeError("write argument must be a string")
 
-    def writelines(self, data):
+        if callback is not None:
+            callback()
+
+    def writelines(self, data, callback=None, prefetch=None, priority=0):
         assert not (isinstance(data, str) or (data is zc.ngi.END_OF_DATA))
-        data = iter(data)
+        more = getattr(data, 'more', None)
+        if more is None:
+            data = iter(data)
+        else:
+            data = iter(lambda : more(PRODUCER_SIZE), '')
         try:
             for d in data:
                 if not isinstance(d, str):
@@ -162,6 +175,9 @@ class Connection:
                 self.write(d)
         except Exception, v:
             self._exception(v)
+        else:
+            if callback is not None:
+                callback()
 
     @property
     def peer_address(self):
@@ -260,6 +276,9 @@ class listener:
     def connections(self):
         return iter(self._connections)
 
+    def broadcast(self, data, max_pending=None, priority=0):
+        return broadcast(self._connections, data, max_pending, priority)
+
     def close(self, handler=None):
         if self.address is not None:
             del _connectable[self.address]
@@ -289,6 +308,26 @@ class peer:
         else:
             handler.connected(Connection(None, self.handler))
 
+def run_in_executor(func, *args):
+    future = zc.ngi.executor.Future(lambda f: f())
+    try:
+        result = func(*args)
+    except Exception, v:
+        future.set_exception(v)
+    else:
+        future.set_result(result)
+    return future
+
+run_in_process = run_in_executor
+
+def broadcast(connections, data, max_pending=None, priority=0):
+    # Testing connections send immediately, so none are skipped.
+    for connection in list(connections):
+        connection = zc.ngi.adapters.unwrap(connection)
+        if not connection.closed:
+            connection.write(data)
+    return run_in_executor(lambda : 0)
+
 # XXX This should move to zope.testing
 import random, socket
 def get_port():
@@ -750,16 +750,1448 @@ def test_get_family_from_address_unix():
     True
     """
 
+def async_write_callbacks():
+    r"""
+    Callbacks passed to write and writelines are called from the
+    implementation thread once the data have been sent.
+
+    >>> done = threading.Event()
+    >>> sent = []
+    >>> def notify(name):
+    ...     return lambda : sent.append(
+    ...         (name, threading.currentThread().getName()))
+
+    >>> def server(conn):
+    ...     conn.write('x'*100000, notify('write'))
+    ...     conn.writelines(('y'*1000 for i in range(100)),
+    ...                     notify('writelines'))
+    ...     conn.write('', done.set)
+
+    >>> listener = zc.ngi.async.listener(None, server)
+
+    >>> @zc.ngi.generator.handler
+    ... def client(conn):
+    ...     n = 0
+    ...     while n < 200000:
+    ...         n += len((yield))
+    ...     print n
+    ...     received.set()
+
+    >>> received = threading.Event()
+    >>> zc.ngi.async.connect(listener.address, client); _ = received.wait(1)
+    200000
+    >>> _ = done.wait(1)
+    >>> sent
+    [('write', 'zc.ngi.async'), ('writelines', 'zc.ngi.async')]
+
+    >>> listener.close()
+    >>> zc.ngi.async.wait(1)
+
+    The testing implementation calls callbacks immediately:
+
+    >>> conn = zc.ngi.testing.Connection()
+    >>> conn.write('hi', notify('test write'))
+    -> 'hi'
+    >>> conn.writelines(['a', 'b'], notify('test writelines'))
+    -> 'a'
+    -> 'b'
+    >>> sent[2:]
+    [('test write', 'MainThread'), ('test writelines', 'MainThread')]
+
+    As do adapters:
+
+    >>> adapter = zc.ngi.adapters.Sized(conn)
+    >>> adapter.write('hi', notify('sized write'))
+    -> '\x00\x00\x00\x02hi'
+    >>> sent[4:]
+    [('sized write', 'MainThread')]
+    """
+
+def async_producers():
+    r"""
+    Producers passed to writelines are asked for data in chunks sized
+    to what can be sent at once.
+
+    >>> class Producer:
+    ...     def __init__(self, size):
+    ...         self.size = size
+    ...         self.calls = 0
+    ...     def more(self, max_bytes):
+    ...         self.calls += 1
+    ...         n = min(self.size, max_bytes)
+    ...         self.size -= n
+    ...         return 'x' * n
+
+    >>> producer = Producer(1000000)
+    >>> def server(conn):
+    ...     conn.writelines(producer)
+    ...     conn.close()
+
+    >>> listener = zc.ngi.async.listener(None, server)
+
+    >>> event = threading.Event()
+    >>> @zc.ngi.generator.handler
+    ... def client(conn):
+    ...     n = 0
+    ...     try:
+    ...         while 1:
+    ...             n += len((yield))
+    ...     except GeneratorExit:
+    ...         print n
+    ...         event.set()
+
+    >>> zc.ngi.async.connect(listener.address, client); _ = event.wait(5)
+    1000000
+    >>> producer.calls < 100
+    True
+
+    Errors raised by producers are passed to handle_exception:
+
+    >>> class BadProducer:
+    ...     def more(self, max_bytes):
+    ...         raise ValueError('bad producer')
+
+    >>> event.clear()
+    >>> class Client:
+    ...     def connected(self, conn):
+    ...         conn.set_handler(self)
+    ...         conn.writelines(BadProducer())
+    ...     def handle_exception(self, conn, exception):
+    ...         print 'exception', exception
+    ...     def handle_close(self, conn, reason):
+    ...         print 'closed', reason
+    ...         event.set()
+
+    >>> zc.ngi.async.connect(listener.address, Client()); _ = event.wait(1)
+    exception bad producer
+    closed bad producer
+
+    >>> listener.close()
+    >>> zc.ngi.async.wait(1)
+
+    Testing connections accept producers too:
+
+    >>> conn = zc.ngi.testing.Connection()
+    >>> conn.writelines(Producer(10))
+    -> 'xxxxxxxxxx'
+    """
+
+def async_prefetching_writelines():
+    r"""
+    If a prefetch size is passed to writelines, the iterator is run
+    in a separate thread so it doesn't block the loop.
+
+    >>> threads = set()
+    >>> def render(n):
+    ...     for i in range(n):
+    ...         threads.add(threading.currentThread().getName())
+    ...         yield 'x' * 1000
+
+    >>> def server(conn):
+    ...     conn.writelines(render(1000), prefetch=10000)
+    ...     conn.close()
+
+    >>> listener = zc.ngi.async.listener(None, server)
+
+    >>> event = threading.Event()
+    >>> @zc.ngi.generator.handler
+    ... def client(conn):
+    ...     n = 0
+    ...     try:
+    ...         while 1:
+    ...             n += len((yield))
+    ...     except GeneratorExit:
+    ...         print n
+    ...         event.set()
+
+    >>> zc.ngi.async.connect(listener.address, client); _ = event.wait(5)
+    1000000
+    >>> sorted(threads)
+    ['zc.ngi.async prefetch']
+
+    Errors raised by the iterator are passed to handle_exception, as
+    usual:
+
+    >>> def bad():
+    ...     yield 'x'
+    ...     raise ValueError('bad iterator')
+
+    >>> event.clear()
+    >>> class Client:
+    ...     def connected(self, conn):
+    ...         conn.set_handler(self)
+    ...         conn.writelines(bad(), prefetch=100)
+    ...     def handle_input(self, conn, data):
+    ...         pass
+    ...     def handle_exception(self, conn, exception):
+    ...         print 'exception', exception
+    ...     def handle_close(self, conn, reason):
+    ...         print 'closed', reason
+    ...         event.set()
+
+    >>> zc.ngi.async.connect(listener.address, Client()); _ = event.wait(1)
+    exception bad iterator
+    closed bad iterator
+
+    Writing to a closed connection doesn't start a prefetching thread:
+
+    >>> def prefetching():
+    ...     return [t for t in threading.enumerate()
+    ...             if t.getName() == 'zc.ngi.async prefetch']
+    >>> listener.close()
+    >>> listener = zc.ngi.async.listener(None, lambda conn: None)
+    >>> wait_until(lambda : not prefetching())
+
+    >>> class Client:
+    ...     def connected(self, conn):
+    ...         connections.append(conn)
+    ...         event.set()
+    >>> connections = []
+    >>> event.clear()
+    >>> zc.ngi.async.connect(listener.address, Client()); _ = event.wait(1)
+    >>> connections[0].close()
+    >>> wait_until(lambda : not connections[0])
+    >>> connections[0].writelines(render(1000), prefetch=10000)
+    Traceback (most recent call last):
+    ...
+    ValueError: writelines called on closed connection
+    >>> prefetching()
+    []
+
+    >>> listener.close()
+    >>> zc.ngi.async.wait(1)
+    """
+
+def async_run_in_executor():
+    r"""
+    Blocking work can be run in a thread pool.  Results are delivered
+    on the implementation's thread:
+
+    >>> impl = zc.ngi.async.Implementation(name='executor test',
+    ...                                    executor_size=2)
+    >>> event = threading.Event()
+    >>> def lookup(key):
+    ...     time.sleep(.01)
+    ...     print threading.currentThread().getName()
+    ...     return key.upper()
+
+    >>> def done(future):
+    ...     print future.result(), threading.currentThread().getName()
+    ...     event.set()
+
+    >>> impl.run_in_executor(lookup, 'a').add_done_callback(done)
+    >>> _ = event.wait(1)
+    executor test executor 1
+    A executor test
+
+    Exceptions are delivered too:
+
+    >>> event.clear()
+    >>> def fail():
+    ...     raise ValueError('failed')
+    >>> future = impl.run_in_executor(fail)
+    >>> future.exception(1)
+    ValueError('failed',)
+    >>> future.result()
+    Traceback (most recent call last):
+    ...
+    ValueError: failed
+
+    >>> future.add_done_callback(lambda f: event.set()); _ = event.wait(1)
+
+    The pool is bounded and keeps some statistics:
+
+    >>> futures = [impl.run_in_executor(time.sleep, .01) for i in range(10)]
+    >>> [f.result(1) for f in futures] == [None] * 10
+    True
+    >>> impl.executor.completed
+    12
+    >>> impl.executor.max_queued > 2
+    True
+    >>> impl.executor.wait_time > 0
+    True
+    >>> len([t for t in threading.enumerate()
+    ...      if t.getName().startswith('executor test executor')])
+    2
+
+    >>> impl.wait(1)
+
+    The testing implementation runs functions immediately:
+
+    >>> def show(f):
+    ...     print f.result()
+    >>> zc.ngi.testing.run_in_executor(str.upper, 'b').add_done_callback(show)
+    B
+    """
+
+def async_run_in_process():
+    r"""
+    CPU-bound work can be run in a pool of processes.  Results are
+    delivered on the implementation's thread:
+
+    >>> impl = zc.ngi.async.Implementation(name='process test',
+    ...                                    process_pool_size=2)
+    >>> event = threading.Event()
+    >>> results = []
+    >>> def done(future):
+    ...     results.append(
+    ...         (future.result(), threading.currentThread().getName()))
+    ...     event.set()
+
+    >>> impl.run_in_process(sum, range(100)).add_done_callback(done)
+    >>> _ = event.wait(5)
+    >>> results
+    [(4950, 'process test')]
+
+    >>> impl.run_in_process(int, 'x').exception(5)
+    ValueError("invalid literal for int() with base 10: 'x'",)
+
+    Functions, arguments and results that can't be pickled cause
+    errors, rather than futures that are never done:
+
+    >>> impl.run_in_process(lambda : 1).exception(5) # doctest: +ELLIPSIS
+    PicklingError(...)
+    >>> impl.run_in_process(len, threading.Lock()).exception(5)
+    ... # doctest: +ELLIPSIS
+    TypeError("can't pickle ...lock objects",)
+    >>> impl.run_in_process(threading.Lock).exception(5)
+    ... # doctest: +ELLIPSIS
+    TypeError("can't pickle ...lock objects",)
+
+    >>> impl.process_executor.completed, impl.process_executor.running
+    (3, 0)
+
+    >>> impl.process_executor.close()
+    >>> impl.wait(1)
+
+    Limiters bound the number of outstanding calls, queueing the rest:
+
+    >>> import zc.ngi.executor
+    >>> submitted = []
+    >>> def submit(func, *args):
+    ...     submitted.append(args)
+    ...     future = zc.ngi.executor.Future(lambda f: f())
+    ...     pending.append((future, func, args))
+    ...     return future
+    >>> pending = []
+
+    >>> limiter = zc.ngi.executor.Limiter(submit, 2)
+    >>> futures = [limiter.submit(str.upper, c) for c in 'abc']
+    >>> submitted
+    [('a',), ('b',)]
+
+    >>> def finish():
+    ...     future, func, args = pending.pop(0)
+    ...     future.set_result(func(*args))
+
+    >>> finish()
+    >>> submitted
+    [('a',), ('b',), ('c',)]
+    >>> finish(); finish()
+    >>> [f.result() for f in futures]
+    ['A', 'B', 'C']
+    >>> limiter.outstanding
+    0
+    """
+
+def count_input(implementation, size=100000):
+    """Return the number of handle_input calls used to read data
+
+    The data are sent and buffered by the operating system before a
+    handler is set on the server connection.
+    """
+    connections = []
+    listener = implementation.listener(('localhost', 0), connections.append)
+    sent = threading.Event()
+    received = threading.Event()
+
+    class Client:
+        def connected(self, connection):
+            connection.write('x' * size, sent.set)
+            connection.close()
+
+    class Counter:
+        calls = n = 0
+        def handle_input(self, connection, data):
+            self.calls += 1
+            self.n += len(data)
+            if self.n == size:
+                received.set()
+
+    implementation.connect(listener.address, Client())
+    sent.wait(5)
+    wait_until(lambda : connections)
+    time.sleep(.1)
+    counter = Counter()
+    implementation.call_from_thread(
+        lambda : connections[0].set_handler(counter))
+    received.wait(5)
+    listener.close()
+    implementation.wait(1)
+    return counter.calls
+
+def async_write_priorities():
+    r"""
+    Output written with a higher priority is sent before lower-priority
+    output that's waiting to be sent:
+
+    >>> def bulk(conn):
+    ...     for i in range(100):
+    ...         if i == 50:
+    ...             conn.write('<control>', priority=1)
+    ...         yield 'x' * 10000
+
+    >>> def server(conn):
+    ...     conn.writelines(bulk(conn))
+    ...     conn.write('<heartbeat>', priority=1)
+    ...     conn.write('<end>', priority=-1)
+    ...     conn.close()
+
+    >>> listener = zc.ngi.async.listener(None, server)
+
+    >>> @zc.ngi.generator.handler
+    ... def client(conn):
+    ...     data = ''
+    ...     while len(data) < 1000025:
+    ...         data += (yield)
+    ...     result.append(data)
+    ...     received.set()
+
+    >>> result = []
+    >>> received = threading.Event()
+    >>> zc.ngi.async.connect(listener.address, client); _ = received.wait(5)
+    >>> [data] = result
+
+    The heartbeat was written after the bulk data, but sent first.
+    Lower-priority data is sent last:
+
+    >>> data[:11], data[-5:]
+    ('<heartbeat>', '<end>')
+
+    Higher-priority output is only sent between strings written or
+    returned by iterators.  The control message was written while the
+    51st string was being produced, and was sent right after the data
+    already taken from the iterator:
+
+    >>> control = data.index('<control>') - 11
+    >>> 500000 < control <= 500000 + zc.ngi.async.SEND_SIZE
+    True
+    >>> control % 10000
+    0
+
+    Threads can write with new priorities at the same time without
+    losing output:
+
+    >>> go = threading.Event()
+    >>> def server(conn):
+    ...     def write(priority):
+    ...         go.wait(5)
+    ...         conn.write('<%02d>' % priority, priority=priority)
+    ...     threads = [threading.Thread(target=write, args=(i, ))
+    ...                for i in range(1, 21)]
+    ...     for thread in threads:
+    ...         thread.start()
+    ...     go.set()
+    ...     for thread in threads:
+    ...         thread.join()
+    ...     conn.close()
+
+    >>> listener.close()
+    >>> listener = zc.ngi.async.listener(None, server)
+    >>> @zc.ngi.generator.handler
+    ... def client(conn):
+    ...     data = ''
+    ...     while len(data) < 80:
+    ...         data += (yield)
+    ...     result.append(data)
+    ...     received.set()
+
+    >>> result = []
+    >>> received.clear()
+    >>> zc.ngi.async.connect(listener.address, client); _ = received.wait(5)
+    >>> [data] = result
+    >>> sorted(data[i:i+4] for i in range(0, 80, 4)) == [
+    ...     '<%02d>' % i for i in range(1, 21)]
+    True
+
+    Producers waiting for data at different priorities don't keep the
+    loop busy:
+
+    >>> go.clear()
+    >>> def slow(name):
+    ...     go.wait(5)
+    ...     yield name
+    >>> def server(conn):
+    ...     conn.writelines(slow('<0>'), prefetch=100)
+    ...     conn.writelines(slow('<1>'), prefetch=100, priority=1)
+    ...     conn.close()
+
+    >>> listener.close()
+    >>> listener = zc.ngi.async.listener(None, server)
+    >>> @zc.ngi.generator.handler
+    ... def client(conn):
+    ...     data = ''
+    ...     while len(data) < 6:
+    ...         data += (yield)
+    ...     result.append(data)
+    ...     received.set()
+
+    >>> result = []
+    >>> received.clear()
+    >>> zc.ngi.async.connect(listener.address, client)
+    >>> time.sleep(.1)
+    >>> start = sum(os.times()[:2])
+    >>> time.sleep(.5)
+    >>> sum(os.times()[:2]) - start < .25
+    True
+    >>> go.set(); _ = received.wait(5)
+    >>> sorted([result[0][:3], result[0][3:]])
+    ['<0>', '<1>']
+
+    Higher-priority output isn't sent between the strings of a tuple
+    passed to writelines, even if it's written while they're being
+    sent.  This lets large strings be sent with headers without being
+    copied:
+
+    >>> started = threading.Event()
+    >>> def server(conn):
+    ...     conn.writelines(('<a>', 'x' * (16 << 20), '<b>'))
+    ...     def control():
+    ...         started.wait(5)
+    ...         conn.write('<hi>', priority=1)
+    ...         conn.close()
+    ...     threading.Thread(target=control).start()
+
+    >>> listener.close()
+    >>> listener = zc.ngi.async.listener(None, server)
+    >>> @zc.ngi.generator.handler
+    ... def client(conn):
+    ...     data = ''
+    ...     while len(data) < (16 << 20) + 10:
+    ...         data += (yield)
+    ...         started.set()
+    ...     result.append(data)
+    ...     received.set()
+
+    >>> result = []
+    >>> received.clear()
+    >>> zc.ngi.async.connect(listener.address, client)
+    >>> _ = received.wait(10)
+    >>> [data] = result
+    >>> data[:4], data[-7:]
+    ('<a>x', '<b><hi>')
+
+    >>> listener.close()
+    >>> zc.ngi.async.wait(1)
+    """
+
+def async_broadcast():
+    r"""
+    Listeners can write a string to all of their connections at once.
+    The data are written below any adapters, so they should be framed
+    once for all of the connections.  Connections with more than
+    ``max_pending`` bytes waiting to be sent are skipped:
+
+    >>> ready = threading.Semaphore(0)
+    >>> @zc.ngi.adapters.Sized.handler
+    ... def server(conn):
+    ...     if (yield) == 'slow':
+    ...         conn.write('x' * (32 << 20))
+    ...     ready.release()
+    ...     while 1:
+    ...         yield
+
+    >>> listener = zc.ngi.async.listener(None, server)
+
+    >>> received = []
+    >>> @zc.ngi.adapters.Sized.handler
+    ... def fast(conn):
+    ...     conn.write('fast')
+    ...     received.append((yield))
+
+    >>> class Slow:
+    ...     def connected(self, conn):
+    ...         self.conn = conn
+    ...         zc.ngi.adapters.Sized(conn).write('slow')
+    >>> slow = Slow()
+
+    >>> for client in fast, fast, slow:
+    ...     zc.ngi.async.connect(listener.address, client)
+    >>> for i in range(3):
+    ...     _ = ready.acquire()
+
+    >>> future = listener.broadcast(zc.ngi.adapters.frame('news'),
+    ...                             max_pending=1<<20)
+    >>> future.result(5)
+    1
+    >>> wait_until(lambda : len(received) == 2)
+    >>> received
+    ['news', 'news']
+
+    Arbitrary groups of connections can be broadcast to using the
+    implementation's broadcast method:
+
+    >>> connections = list(listener.connections())
+    >>> zc.ngi.async.broadcast(connections, '').result(5)
+    0
+
+    >>> slow.conn.close()
+    >>> listener.close()
+    >>> zc.ngi.async.wait(1)
+
+    The testing implementation supports broadcast too:
+
+    >>> listener = zc.ngi.testing.listener(lambda conn: None)
+    >>> conn1 = listener.connect()
+    >>> conn2 = listener.connect()
+    >>> listener.broadcast('hi').result()
+    -> 'hi'
+    -> 'hi'
+    0
+    >>> listener.close()
+    -> CLOSE
+    -> CLOSE
+    """
+
+def async_timers():
+    r"""
+    Functions can be called from an implementation's loop after a
+    delay:
+
+    >>> impl = zc.ngi.async.Implementation(name='timer test')
+    >>> called = []
+    >>> event = threading.Event()
+    >>> def later(name):
+    ...     called.append((name, threading.currentThread().getName()))
+    ...     event.set()
+
+    >>> start = time.time()
+    >>> timer = impl.call_later(.2, lambda : later('cancelled'))
+    >>> _ = impl.call_later(.1, lambda : later('later'))
+    >>> timer.cancel()
+    >>> _ = event.wait(5)
+    >>> called, time.time() - start >= .1
+    ([('later', 'timer test')], True)
+    >>> impl.wait(1)
+    """
+
+def async_rate_limits():
+    r"""
+    Connections can limit the rate at which they read and write:
+
+    >>> done = threading.Event()
+    >>> def server(conn):
+    ...     conn.set_rate_limits(write=1000000)
+    ...     conn.write('x' * 1000000, done.set)
+    ...     connections.append(conn)
+
+    >>> @zc.ngi.generator.handler
+    ... def client(conn):
+    ...     n = 0
+    ...     while n < 1000000:
+    ...         n += len((yield))
+    ...     times.append(time.time())
+
+    >>> connections = []
+    >>> times = [time.time()]
+    >>> impl = zc.ngi.async.Implementation(name='rate test')
+    >>> listener = impl.listener(('localhost', 0), server)
+    >>> impl.connect(listener.address, client)
+    >>> _ = done.wait(10)
+    >>> wait_until(lambda : len(times) == 2)
+
+    The first 100000 bytes can be sent at once.  It takes about .9
+    seconds to send the rest:
+
+    >>> .8 < times[1] - times[0] < 5
+    True
+
+    The buckets used to limit rates report current rates for
+    monitoring:
+
+    >>> bucket = connections[0].write_limit
+    >>> bucket.rate, bucket.total, bucket.current_rate() > 0
+    (1000000, 1000000, True)
+
+    Listeners can limit rates for all of their connections together,
+    and for each connection:
+
+    >>> listener.set_rate_limits(read=500000, connection_read=1000000)
+    >>> wait_until(lambda : connections[0].read_limit is not None)
+    >>> connections[0].read_limit.rate
+    1000000
+
+    >>> class Sender:
+    ...     def connected(self, conn):
+    ...         conn.write('x' * 250000)
+    >>> received = []
+    >>> @zc.ngi.generator.handler
+    ... def server(conn):
+    ...     n = 0
+    ...     while n < 250000:
+    ...         n += len((yield))
+    ...     received.append(time.time())
+    >>> listener.close()
+    >>> listener = impl.listener(('localhost', 0), server)
+    >>> listener.set_rate_limits(read=500000)
+    >>> start = time.time()
+    >>> impl.connect(listener.address, Sender())
+    >>> impl.connect(listener.address, Sender())
+    >>> wait_until(lambda : len(received) == 2)
+    >>> .8 < max(received) - start < 5
+    True
+    >>> listener.read_limit.total
+    500000
+
+    Connections that find a shared bucket empty wait for it to refill,
+    rather than reading nothing, which would look like the end of
+    input:
+
+    >>> class Server:
+    ...     def __init__(self, conn):
+    ...         self.n = 0
+    ...         conn.set_handler(self)
+    ...     def handle_input(self, conn, data):
+    ...         self.n += len(data)
+    ...         if self.n == 20000:
+    ...             received.append(self.n)
+    ...     def handle_close(self, conn, reason):
+    ...         closed.append(reason)
+    >>> class Sender:
+    ...     def connected(self, conn):
+    ...         conn.write('x' * 20000)
+    ...     def failed_connect(self, reason):
+    ...         print 'failed', reason
+    >>> received, closed = [], []
+    >>> listener.close()
+    >>> listener = impl.listener(('localhost', 0), Server)
+    >>> listener.set_rate_limits(read=20000)
+    >>> for i in range(4):
+    ...     impl.connect(listener.address, Sender())
+    >>> wait_until(lambda : len(received) == 4)
+    >>> closed
+    []
+
+    Connections that wait for a shared bucket share it equally, so
+    they get similar throughput:
+
+    >>> class Server:
+    ...     def __init__(self, conn):
+    ...         counts.append(0)
+    ...         self.index = len(counts) - 1
+    ...         conn.set_handler(self)
+    ...     def handle_input(self, conn, data):
+    ...         counts[self.index] += len(data)
+    ...     def handle_close(self, conn, reason):
+    ...         pass
+    >>> class Sender:
+    ...     def connected(self, conn):
+    ...         conn.write('x' * 1000000)
+    ...         senders.append(conn)
+    >>> counts, senders = [], []
+    >>> listener.close()
+    >>> listener = impl.listener(('localhost', 0), Server)
+    >>> listener.set_rate_limits(read=40000)
+    >>> for i in range(4):
+    ...     impl.connect(listener.address, Sender())
+    >>> wait_until(lambda : sum(counts) > 100000)
+    >>> min(counts) > max(counts) / 2
+    True
+    >>> for conn in senders:
+    ...     conn.close()
+
+    >>> listener.close()
+    >>> impl.cleanup_map()
+    >>> impl.wait(1)
+    """
+
+def async_output_limits():
+    r"""
+    Implementations keep track of the output buffered by their
+    connections.  Connections can limit how much output they buffer.
+    With the 'signal' policy, the handler's ``handle_exception``
+    method is called with an ``OutputBacklog`` exception:
+
+    >>> class Server:
+    ...     def __init__(self, conn):
+    ...         conn.set_handler(self)
+    ...         conn.set_output_policy(1 << 20, 'signal')
+    ...         connections.append(conn)
+    ...         for i in range(512):
+    ...             conn.write('x' * (64 << 10))
+    ...     def handle_input(self, conn, data):
+    ...         pass
+    ...     def handle_exception(self, conn, exception):
+    ...         exceptions.append(exception)
+    ...     def handle_close(self, conn, reason):
+    ...         closed.append(reason)
+
+    >>> connections, exceptions, closed = [], [], []
+    >>> impl = zc.ngi.async.Implementation(name='output test')
+    >>> listener = impl.listener(('localhost', 0), Server)
+    >>> client = socket.create_connection(listener.address)
+    >>> wait_until(lambda : exceptions)
+    >>> exceptions[0].args[0], exceptions[0].args[1] > (1 << 20)
+    ('output limit exceeded', True)
+    >>> impl.output_bytes > (1 << 20)
+    True
+
+    The connections with the most buffered output can be listed, with
+    the number of seconds since each last sent anything:
+
+    >>> [(size > (1 << 20), connection is connections[0])
+    ...  for (size, stalled, connection) in impl.output_offenders()]
+    [(True, True)]
+
+    With the 'drop' policy, buffered output is discarded.  Data that
+    have been partly sent are kept, so the peer doesn't get partial
+    writes:
+
+    >>> called = []
+    >>> connections[0].write('x', lambda : called.append('x'))
+    >>> connections[0].set_output_policy(1 << 20, 'drop')
+    >>> connections[0].write('x')
+    >>> wait_until(lambda : impl.output_bytes < (1 << 20))
+    >>> closed
+    []
+
+    Callbacks for data that were dropped aren't called:
+
+    >>> sent = threading.Event()
+    >>> connections[0].write('y', sent.set)
+    >>> client.settimeout(.1)
+    >>> while not sent.isSet():
+    ...     try:
+    ...         _ = client.recv(1 << 20)
+    ...     except socket.timeout:
+    ...         pass
+    >>> called
+    []
+
+    With the default, 'close', policy, the connection is closed:
+
+    >>> connections[0].set_output_policy(1 << 20)
+    >>> connections[0].write('x' * (32 << 20))
+    >>> wait_until(lambda : closed)
+    >>> closed, impl.output_bytes
+    (['output limit exceeded'], 0)
+    >>> client.close()
+
+    Implementations can limit the total output buffered.  When the
+    limit is exceeded, connections with more than their share are
+    handled according to their policies.  Connections can also be
+    handled if they haven't sent anything for a stall timeout:
+
+    >>> impl.max_output = 4 << 20
+    >>> impl.stall_timeout = 1
+    >>> class Server(Server):
+    ...     def __init__(self, conn):
+    ...         conn.set_handler(self)
+    ...         connections.append(conn)
+    ...         conn.write('x' * (8 << 20))
+    >>> listener.close()
+    >>> listener = impl.listener(('localhost', 0), Server)
+    >>> del closed[:]
+    >>> client = socket.create_connection(listener.address)
+    >>> wait_until(lambda : closed)
+    >>> closed
+    ['output share exceeded']
+    >>> client.close()
+
+    >>> impl.max_output = None
+    >>> impl.output_check_interval = .1
+    >>> class Server(Server):
+    ...     def __init__(self, conn):
+    ...         conn.set_handler(self)
+    ...         connections.append(conn)
+    ...         conn.write('x' * (16 << 20))
+    >>> del closed[:]
+    >>> client = socket.create_connection(listener.address)
+    >>> wait_until(lambda : closed)
+    >>> closed
+    ['output stalled']
+    >>> client.close()
+
+    The number of times connections exceeded limits is counted:
+
+    >>> impl.output_limit_exceeded >= 5
+    True
+
+    >>> listener.close()
+    >>> impl.wait(1)
+    """
+
+def async_stats():
+    r"""
+    Implementations, listeners and connections keep statistics that
+    can be read from any thread:
+
+    >>> @zc.ngi.generator.handler
+    ... def echo(conn):
+    ...     connections.append(conn)
+    ...     while 1:
+    ...         conn.write((yield))
+
+    >>> @zc.ngi.generator.handler
+    ... def client(conn):
+    ...     conn.write('x' * 1000)
+    ...     n = 0
+    ...     while n < 1000:
+    ...         n += len((yield))
+    ...     done.set()
+    ...     while 1:
+    ...         yield
+
+    >>> connections = []
+    >>> done = threading.Event()
+    >>> impl = zc.ngi.async.Implementation(name='stats test')
+    >>> listener = impl.listener(('localhost', 0), echo)
+    >>> impl.connect(listener.address, client)
+    >>> done.wait(5)
+    True
+
+    >>> stats = impl.stats()
+    >>> stats['connections'], stats['listeners'], stats['connections_opened']
+    (2, 1, 2)
+    >>> stats['bytes_read'], stats['bytes_written']
+    (2000, 2000)
+    >>> stats['loop_iterations'] > 0, stats['trigger_pulls'] > 0
+    (True, True)
+
+    >>> import pprint
+    >>> pprint.pprint(listener.stats())
+    {'accept_errors': 0, 'accepted': 1, 'connections': 1, 'connections_closed': 0}
+
+    >>> stats = connections[0].stats()
+    >>> stats['bytes_read'], stats['bytes_written'], stats['output_bytes']
+    (1000, 1000, 0)
+
+    Statistics can be formatted in a text format for scraping:
+
+    >>> import zc.ngi.stats
+    >>> text = zc.ngi.stats.exposition([impl])
+    >>> text = text.replace(repr(listener.address), 'ADDRESS')
+    >>> print '\n'.join(line for line in text.split('\n')
+    ...                 if 'bytes_read' in line or 'accepted' in line),
+    # TYPE zc_ngi_bytes_read_total counter
+    zc_ngi_bytes_read_total{implementation="stats test"} 2000
+    # TYPE zc_ngi_listener_accepted_total counter
+    zc_ngi_listener_accepted_total{implementation="stats test",listener="ADDRESS"} 1
+
+    >>> listener.close()
+    >>> impl.wait(1)
+    >>> impl.stats()['connections_closed']
+    2
+    """
+
+def async_watchdog():
+    r"""
+    A watchdog thread can be started to notice when an implementation's
+    loop spends too long on an iteration, typically because a handler
+    is slow:
+
+    >>> import zope.testing.loggingsupport
+    >>> loghandler = zope.testing.loggingsupport.InstalledHandler(
+    ...     'zc.ngi.async.watchdog')
+
+    >>> class Slow:
+    ...     def __init__(self, conn):
+    ...         conn.set_handler(self)
+    ...     def handle_input(self, conn, data):
+    ...         time.sleep(.5)
+    ...         conn.write(data)
+
+    >>> @zc.ngi.generator.handler
+    ... def client(conn):
+    ...     conn.write('x')
+    ...     (yield)
+    ...     done.set()
+
+    >>> done = threading.Event()
+    >>> impl = zc.ngi.async.Implementation(name='watched')
+    >>> impl.start_watchdog(.1)
+    >>> listener = impl.listener(('localhost', 0), Slow)
+    >>> impl.connect(listener.address, client)
+    >>> done.wait(5)
+    True
+
+    The stall is counted and logged, with the dispatcher and handler
+    method that were running, and the loop thread's stack:
+
+    >>> impl.stats()['loop_stalls']
+    1
+    >>> [record] = loghandler.records
+    >>> name, elapsed, where, stack = record.args
+    >>> name, elapsed >= .1
+    ('watched', True)
+    >>> print where # doctest: +ELLIPSIS
+    _ServerConnectionDispatcher (...) __read calling Slow.handle_input
+    >>> print stack.splitlines()[-1].strip()
+    time.sleep(.5)
+
+    The time spent working in each loop iteration is recorded in a
+    histogram:
+
+    >>> loop_times = impl.stats()['loop_times']
+    >>> loop_times.count > 0, loop_times.max >= .5
+    (True, True)
+    >>> loop_times.percentile(100) == loop_times.max
+    True
+
+    Stopping the watchdog stops recording loop times:
+
+    >>> impl.stop_watchdog()
+    >>> impl.loop_times, 'loop_times' in impl.stats()
+    (None, False)
+
+    >>> listener.close()
+    >>> impl.wait(1)
+    >>> loghandler.uninstall()
+    """
+
+def async_request_timing():
+    r"""
+    Listeners can time requests on their connections.  The time
+    handlers take to handle input, and the times from input arriving
+    to the first and last bytes of responses being sent, are recorded
+    in histograms:
+
+    >>> class Server:
+    ...     def __init__(self, conn):
+    ...         conn.set_handler(self)
+    ...     def handle_input(self, conn, data):
+    ...         time.sleep(.01)
+    ...         conn.write(data * 1000)
+
+    >>> @zc.ngi.generator.handler
+    ... def client(conn):
+    ...     for i in range(3):
+    ...         conn.write('x')
+    ...         n = 0
+    ...         while n < 1000:
+    ...             n += len((yield))
+    ...     done.set()
+
+    >>> done = threading.Event()
+    >>> impl = zc.ngi.async.Implementation(name='timing test')
+    >>> listener = impl.listener(('localhost', 0), Server)
+    >>> listener.set_timing()
+    >>> impl.connect(listener.address, client)
+    >>> done.wait(5)
+    True
+
+    >>> timing = listener.timing
+    >>> timing.handler.count, timing.first_byte.count
+    (3, 3)
+    >>> wait_until(lambda : timing.last_byte.count == 3)
+    >>> .01 <= timing.handler.max <= timing.first_byte.max
+    True
+    >>> timing.first_byte.sum <= timing.last_byte.sum
+    True
+
+    The histograms are included in the listener's statistics:
+
+    >>> listener.stats()['handler_times'] is timing.handler
+    True
+    >>> import zc.ngi.stats
+    >>> text = zc.ngi.stats.exposition([impl])
+    >>> print [line for line in text.split('\n')
+    ...        if line.startswith('zc_ngi_listener_handler_times_count')
+    ...        ][0].replace(repr(listener.address), 'ADDRESS')
+    zc_ngi_listener_handler_times_count{implementation="timing test",listener="ADDRESS"} 3
+
+    >>> listener.close()
+    >>> impl.wait(1)
+    """
+
+def async_tcp_info():
+    r"""
+    Implementations can periodically sample the kernel's information
+    about their TCP connections, where it's available, to tell slow
+    peers from slow handlers:
+
+    >>> @zc.ngi.generator.handler
+    ... def echo(conn):
+    ...     connections.append(conn)
+    ...     while 1:
+    ...         conn.write((yield))
+
+    >>> @zc.ngi.generator.handler
+    ... def client(conn):
+    ...     conn.write('x')
+    ...     (yield)
+    ...     done.set()
+    ...     while 1:
+    ...         yield
+
+    >>> connections = []
+    >>> done = threading.Event()
+    >>> impl = zc.ngi.async.Implementation(name='tcp info test')
+    >>> impl.start_tcp_sampling(.05)
+    >>> listener = impl.listener(('localhost', 0), echo)
+    >>> impl.connect(listener.address, client)
+    >>> done.wait(5)
+    True
+
+    >>> wait_until(lambda : connections[0].tcp_info is not None)
+    >>> info = connections[0].tcp_info
+    >>> print ' '.join(sorted(info))
+    lost output_bytes retrans retransmits rtt rttvar snd_cwnd state total_retrans unacked
+    >>> info['rtt'] >= 0, info['output_bytes']
+    (True, 0)
+
+    Listeners aggregate the samples of their connections:
+
+    >>> wait_until(lambda : listener.tcp_stats is not None)
+    >>> stats = listener.stats()
+    >>> stats['tcp_connections'], stats['tcp_rtt'].count > 0
+    (1, True)
+
+    >>> impl.stop_tcp_sampling()
+    >>> listener.close()
+    >>> impl.wait(1)
+    """
+
+def async_trace():
+    r"""
+    Implementations can record recent connection events in a ring
+    buffer, rather than logging every read and write:
+
+    >>> @zc.ngi.generator.handler
+    ... def echo(conn):
+    ...     while 1:
+    ...         conn.write((yield))
+
+    >>> @zc.ngi.generator.handler
+    ... def client(conn):
+    ...     conn.write('hello')
+    ...     (yield)
+    ...     conn.close()
+    ...     done.set()
+
+    >>> done = threading.Event()
+    >>> impl = zc.ngi.async.Implementation(name='trace test')
+    >>> impl.start_trace(size=100)
+    >>> listener = impl.listener(('localhost', 0), echo)
+    >>> impl.connect(listener.address, client)
+    >>> done.wait(5)
+    True
+    >>> wait_until(lambda : [e for e in impl.trace.dump() if e[2] == 'close'
+    ...                      ][1:])
+
+    Events are tuples of a time, a connection id, an event name and a
+    value.  They can be dumped for a connection:
+
+    >>> events = impl.trace.dump()
+    >>> [client_id] = [e[1] for e in events if e[2] == 'connect']
+    >>> [server_id] = [e[1] for e in events if e[2] == 'accept']
+    >>> for t, ident, event, value in impl.trace.dump(client_id):
+    ...     print event, value # doctest: +ELLIPSIS
+    connect ('localhost', ...)
+    write 5
+    read 5
+    close closed
+    >>> for t, ident, event, value in impl.trace.dump(server_id):
+    ...     print event, value # doctest: +ELLIPSIS
+    accept ('127.0.0.1', ...)
+    read 5
+    write 5
+    close end of input
+
+    And formatted as text:
+
+    >>> print impl.trace.format(client_id).split('\n')[1] # doctest: +ELLIPSIS
+    20...-...-...T...:...:... ... write   5
+
+    The buffer holds the most recent events:
+
+    >>> for i in range(200):
+    ...     impl.trace.record(0, 'test', i)
+    >>> [value for (t, ident, event, value) in impl.trace.dump()
+    ...  ] == range(100, 200)
+    True
+
+    Connections can be sampled:
+
+    >>> impl.start_trace(sample=2)
+    >>> for i in range(4):
+    ...     impl.trace.record(i, 'test')
+    >>> [ident for (t, ident, event, value) in impl.trace.dump()]
+    [0, 2]
+
+    >>> impl.stop_trace() is not None, impl.trace
+    (True, None)
+    >>> listener.close()
+    >>> impl.wait(1)
+    """
+
+def async_control():
+    r"""
+    A control listener serves introspection commands on a Unix socket,
+    one per line.  Responses end with empty lines:
+
+    >>> import zc.ngi.control
+    >>> control = zc.ngi.control.Control('control')
+
+    >>> client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    >>> client.connect('control')
+    >>> def command(line):
+    ...     client.sendall(line + '\n')
+    ...     response = ''
+    ...     while not response.endswith('\n\n'):
+    ...         response += client.recv(1 << 16)
+    ...     return response[:-2]
+
+    >>> print command('help')
+    close id: close a connection
+    connections: a table of open connections
+    help: list commands
+    profile on | off [limit]: profile implementation loops
+    snapshot: implementations, listeners and connections, as JSON
+    stats: statistics in the Prometheus text format
+    trace on [size [sample]] | off | dump [id]: event tracing
+
+    Let's create an implementation with some connections to look at:
+
+    >>> class Echo:
+    ...     def __init__(self, conn):
+    ...         zc.ngi.adapters.Lines(conn).set_handler(self)
+    ...     def handle_input(self, conn, line):
+    ...         conn.write(line + '\n')
+    ...     def handle_close(self, conn, reason):
+    ...         closed.append(reason)
+
+    >>> @zc.ngi.adapters.Lines.handler
+    ... def client_handler(conn):
+    ...     conn.write('hi\n')
+    ...     (yield)
+    ...     done.set()
+    ...     while 1:
+    ...         yield
+
+    >>> closed = []
+    >>> done = threading.Event()
+    >>> impl = zc.ngi.async.Implementation(name='app')
+    >>> listener = impl.listener(('localhost', 0), Echo)
+    >>> impl.connect(listener.address, client_handler)
+    >>> done.wait(5)
+    True
+
+    The connections command lists open connections with their peer
+    addresses, ages, idle times, bytes read, written and buffered, and
+    handlers:
+
+    >>> lines = command('connections').split('\n')
+    >>> print lines[0]
+        id implementation       peer                          age     idle       read    written     output handler
+    >>> for line in lines[1:]:
+    ...     words = line.split()
+    ...     if words[1] == 'app':
+    ...         print words[5:]
+    ['3', '3', '0', 'Lines(Echo)']
+    ['3', '3', '0', 'Lines(ConnectionHandler)']
+
+    The snapshot command returns everything known about
+    implementations, taken in their loop threads, as JSON:
+
+    >>> import json
+    >>> [snapshot] = [s for s in json.loads(command('snapshot'))
+    ...               if s['name'] == 'app']
+    >>> len(snapshot['connections']), snapshot['stats']['callbacks']
+    (2, 0)
+    >>> [listener_snapshot] = snapshot['listeners']
+    >>> listener_snapshot['accepting'], listener_snapshot['stats']['accepted']
+    (True, 1)
+
+    The stats command returns statistics in the Prometheus text format:
+
+    >>> print [line for line in command('stats').split('\n')
+    ...        if line.startswith('zc_ngi_connections{implementation="app"}')]
+    ['zc_ngi_connections{implementation="app"} 2']
+
+    Tracing and profiling can be turned on and off:
+
+    >>> print command('trace on 100')[:7]
+    tracing
+    >>> listener.connect(client_handler)
+    >>> wait_until(lambda : 'accept' in command('trace dump'))
+    >>> print command('trace off')
+    tracing stopped
+
+    >>> print command('profile on')[:9]
+    profiling
+    >>> 'function calls' in command('profile off')
+    True
+    >>> print command('profile off')
+    not profiling
+
+    Connections can be closed by id:
+
+    >>> [server_id] = [c['id'] for c in snapshot['connections']
+    ...                if c['handler'] == 'Lines(Echo)']
+    >>> print command('close %s' % server_id) # doctest: +ELLIPSIS
+    closed ...
+    >>> closed
+    ['closed by control']
+    >>> print command('close %s' % server_id) # doctest: +ELLIPSIS
+    no connection ...
+
+    Errors are reported:
+
+    >>> print command('launch')
+    error: unknown command 'launch'
+    >>> print command('close x')
+    error: invalid literal for int() with base 10: 'x'
+
+    >>> client.close()
+    >>> control.close()
+    >>> listener.close()
+    >>> impl.wait(1)
+    >>> control.implementation.wait(1)
+    """
+
+def async_coalesced_reads():
+    r"""
+    Normally, input is read and passed to handlers in chunks of up to
+    BUFFER_SIZE bytes.  An implementation can be asked to coalesce
+    reads, in which case each read event collects up to the given
+    number of bytes and passes them to the handler in a single call.
+
+    >>> count_input(zc.ngi.async.Implementation(name='reads')) > 1
+    True
+
+    >>> count_input(zc.ngi.async.Implementation(
+    ...     name='coalesced reads', coalesce_reads=1<<20))
+    1
+    """
+
+def async_budgets():
+    r"""
+    To keep busy connections from delaying others, the work done for
+    each connection in a loop pass is limited by read and write
+    budgets.  Reading stops once a connection's read budget is used,
+    and resumes in the next pass:
+
+    >>> count_input(zc.ngi.async.Implementation(
+    ...     name='budgeted reads', coalesce_reads=1<<20, read_budget=30000))
+    4
+
+    The number of callbacks run in a pass is limited too.  Leftover
+    callbacks are run after polling for events without waiting:
+
+    >>> import asyncore
+    >>> polls = []
+    >>> orig_poll = asyncore.poll
+    >>> def poll(timeout, map):
+    ...     polls.append(timeout)
+    ...     orig_poll(timeout, map)
+    >>> asyncore.poll = poll
+
+    >>> impl = zc.ngi.async.Inline(callback_budget=2)
+    >>> listener = impl.listener(None, lambda conn: None)
+    >>> passes = []
+    >>> for i in range(4):
+    ...     impl.call_from_thread(lambda : passes.append(len(polls)))
+    >>> impl.call_from_thread(listener.close)
+    >>> impl.wait(5)
+    >>> passes
+    [0, 0, 1, 1]
+    >>> polls[:2]
+    [0.0, 0.0]
+
+    >>> asyncore.poll = orig_poll
+    """
+
+def async_tls():
+    r"""
+    Listeners and connections can use TLS by passing SSL contexts.
+    Handshakes are done without blocking the implementation thread:
+
+    >>> import ssl
+    >>> certfile = os.path.join(os.path.dirname(__file__), 'tests.pem')
+    >>> server_context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+    >>> server_context.load_cert_chain(certfile)
+    >>> client_context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+    >>> client_context.verify_mode = ssl.CERT_REQUIRED
+    >>> client_context.check_hostname = True
+    >>> client_context.load_verify_locations(certfile)
+
+    >>> @zc.ngi.generator.handler
+    ... def echo(conn):
+    ...     while 1:
+    ...         conn.write((yield))
+
+    >>> impl = zc.ngi.async.Implementation(name='tls test')
+    >>> listener = impl.listener(('localhost', 0), echo,
+    ...                          ssl_context=server_context)
+
+    >>> @zc.ngi.generator.handler
+    ... def client(conn):
+    ...     conn.write('x' * 100000)
+    ...     n = 0
+    ...     while n < 100000:
+    ...         n += len((yield))
+    ...     print n
+    ...     received.set()
+
+    >>> received = threading.Event()
+    >>> impl.connect(listener.address, client, ssl_context=client_context)
+    >>> _ = received.wait(5)
+    100000
+
+    Handshake times are recorded:
+
+    >>> impl.tls_handshakes, impl.tls_handshake_failures
+    (2, 0)
+    >>> 0 < impl.tls_max_handshake_time <= impl.tls_handshake_time
+    True
+
+    Failed handshakes close connections:
+
+    >>> class Failed:
+    ...     def connected(self, conn):
+    ...         conn.set_handler(self)
+    ...     def handle_close(self, conn, reason):
+    ...         event.set()
+    >>> event = threading.Event()
+    >>> untrusting_context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+    >>> untrusting_context.verify_mode = ssl.CERT_REQUIRED
+    >>> impl.connect(listener.address, Failed(),
+    ...              ssl_context=untrusting_context)
+    >>> event.wait(5)
+    True
+
+    The client rejected the server's certificate, and the server saw
+    the handshake fail:
+
+    >>> wait_until(lambda : impl.tls_handshake_failures == 2)
+    >>> impl.tls_handshakes
+    2
+
+    If the ``ssl`` module supports it, client sessions are cached by
+    address, so that reconnecting can resume sessions.
+
+    >>> (listener.address in impl.tls_sessions
+    ...  ) == zc.ngi.async.tls_sessions_supported
+    True
+
+    >>> listener.close()
+    >>> impl.wait(1)
+    """
+
 if not hasattr(socket, 'AF_UNIX'):
     # windows
     del (
-        async_peer_address_unix, async_close_unix,
+        async_peer_address_unix, async_close_unix, async_control,
         test_get_family_from_address_unix
     )
 
 if sys.version_info < (2, 6):
     del setHandler_compatibility
 
+if not zc.ngi.async.tcp_info_supported:
+    del async_tcp_info
+
 class BrokenConnect:
 
     connected = failed_connect = __call__ = lambda: xxxxx